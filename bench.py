@@ -0,0 +1,787 @@
+#!/usr/bin/env python3
+"""Benchmark of CKAN synchronization against local fake CKAN instances.
+
+Two in-process stand-ins for the CKAN action API (source and target) are
+seeded with generated organizations, packages and resources, then several
+sync scenarios are run between them. For each scenario the wall time,
+number of API calls per package, bytes moved over HTTP and peak Python
+memory (including buffers of the fake servers) are reported, and can be
+compared with a stored baseline.
+"""
+
+
+import argparse
+import datetime
+import email.parser
+import hashlib
+import http.server
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+
+from urllib.parse import urlparse, parse_qsl
+
+import sync
+
+
+def now():
+    return datetime.datetime.utcnow().isoformat()
+
+
+class FakeCkan:
+    """In-process stand-in for CKAN action API with revisions, activity
+    stream and file storage, serving subset of API used by sync.py.
+    Every request is delayed by given latency (in seconds). Without
+    revision_ids, resources lack revision_id like in CKAN 2.9+.
+    """
+    def __init__(self, latency=0.0, revision_ids=True):
+        self.latency = latency
+        self.revision_ids = revision_ids
+        # like ckan.search.rows_max of CKAN
+        self.rows_max = 1000
+        self.orgs = {}
+        self.packages = {}
+        self.files = {}
+        self.revisions = []
+        self.activities = []
+        self.calls = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lock = threading.RLock()
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%s' % self.server.server_address[1]
+        self.api_url = self.url + '/api/3/'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def __str__(self):
+        return "<FakeCkan %s>" % self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls = {}
+            self.bytes_in = 0
+            self.bytes_out = 0
+
+    # Seeding & changes
+
+    def add_revision(self, packages=(), groups=()):
+        rev = {
+            'id': str(uuid.uuid4()),
+            'timestamp': now(),
+            'packages': list(packages),
+            'groups': list(groups)}
+        self.revisions.append(rev)
+        for name in packages:
+            self.activities.append({
+                'id': str(uuid.uuid4()),
+                'timestamp': rev['timestamp'],
+                'object_id': name,
+                'activity_type': 'changed package',
+                'data': {'package': {'name': name}}})
+        for name in groups:
+            self.activities.append({
+                'id': str(uuid.uuid4()),
+                'timestamp': rev['timestamp'],
+                'object_id': name,
+                'activity_type': 'changed organization',
+                'data': {'group': {'name': name}}})
+        return rev['id']
+
+    def add_org(self, name):
+        path = 'img/%s.png' % name
+        self.files[path] = b'PNG' + name.encode()
+        self.orgs[name] = {
+            'id': str(uuid.uuid4()),
+            'name': name,
+            'title': name,
+            'display_name': name,
+            'description': '',
+            'state': 'active',
+            'type': 'organization',
+            'approval_status': 'approved',
+            'extras': [],
+            'image_display_url': '%s/files/%s' % (self.url, path)}
+        self.add_revision(groups=[name])
+
+    def add_package(self, name, org, resources=()):
+        '''Adds package with resources given as dicts; resources with 'data'
+        key are uploads with that content.
+        '''
+        package = {
+            'id': str(uuid.uuid4()),
+            'name': name,
+            'title': name,
+            'notes': '',
+            'state': 'active',
+            'private': False,
+            'extras': [],
+            'tags': [],
+            'owner_org': org,
+            'organization': {'name': org},
+            'metadata_modified': now(),
+            'resources': []}
+        self.packages[name] = package
+        for res in resources:
+            self._add_resource(package, dict(res))
+        self.add_revision(packages=[name])
+        return package
+
+    def change_package(self, name, **changes):
+        package = self.packages[name]
+        package.update(changes)
+        package['metadata_modified'] = now()
+        self.add_revision(packages=[name])
+
+    def change_file(self, name, data):
+        '''Replaces content of the first uploaded resource of package.'''
+        package = self.packages[name]
+        for res in package['resources']:
+            if res['url_type'] == 'upload':
+                self._store_upload(res, (res['name'], data))
+                self._touch_resource(res)
+                break
+        package['metadata_modified'] = now()
+        self.add_revision(packages=[name])
+
+    def _add_resource(self, package, res, upload=None):
+        res.setdefault('id', str(uuid.uuid4()))
+        res.setdefault('url_type', '')
+        res.setdefault('hash', '')
+        res.setdefault('last_modified', None)
+        self._touch_resource(res)
+        res['package_id'] = package['id']
+        if 'data' in res:
+            upload = (res.get('name') or 'file', res.pop('data'))
+        if upload:
+            self._store_upload(res, upload)
+        package['resources'].append(res)
+        return res
+
+    def _touch_resource(self, res):
+        res['metadata_modified'] = now()
+        if self.revision_ids:
+            res['revision_id'] = str(uuid.uuid4())
+
+    def _store_upload(self, res, upload):
+        filename, data = upload
+        path = 'res/%s/%s' % (res['id'], os.path.basename(filename))
+        self.files[path] = data
+        res.update({
+            'url': '%s/files/%s' % (self.url, path),
+            'url_type': 'upload',
+            'size': len(data),
+            'last_modified': now()})
+
+    def _find_resource(self, resource_id):
+        for package in self.packages.values():
+            for res in package['resources']:
+                if res['id'] == resource_id:
+                    return package, res
+        raise KeyError(resource_id)
+
+    def _active_packages(self):
+        return [p for p in self.packages.values() if p['state'] == 'active']
+
+    # HTTP
+
+    def _handler(self):
+        ckan = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def read_body(self):
+                if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                    body = bytearray()
+                    while True:
+                        size = int(self.rfile.readline().strip(), 16)
+                        if size == 0:
+                            self.rfile.readline()
+                            return bytes(body)
+                        body += self.rfile.read(size)
+                        self.rfile.readline()
+                return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+            def send(self, code, body, content_type='application/json',
+                     headers=()):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for header in headers:
+                    self.send_header(*header)
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+                    with ckan.lock:
+                        ckan.bytes_out += len(body)
+
+            def do_HEAD(self):
+                self.handle_request(b'')
+
+            def do_GET(self):
+                self.handle_request(b'')
+
+            def do_POST(self):
+                self.handle_request(self.read_body())
+
+            def handle_request(self, body):
+                if ckan.latency:
+                    time.sleep(ckan.latency)
+                with ckan.lock:
+                    ckan.bytes_in += len(body)
+                url = urlparse(self.path)
+                if url.path.startswith('/files/'):
+                    return self.send_file(url.path[len('/files/'):])
+                if url.path.startswith('/ckan-admin/trash'):
+                    return self.send(200, b'', 'text/html')
+                action = url.path.rsplit('/', 1)[-1]
+                with ckan.lock:
+                    ckan.calls[action] = ckan.calls.get(action, 0) + 1
+                params, files = self.parse_params(url.query, body)
+                handler = getattr(ckan, 'action_' + action, None)
+                if handler is None:
+                    return self.send(400, {
+                        'success': False,
+                        'error': {'message': 'Unknown action %s' % action}})
+                try:
+                    with ckan.lock:
+                        result = handler(params, files)
+                except KeyError as e:
+                    return self.send(404, {
+                        'success': False,
+                        'error': {'message': 'Not found: %s' % e}})
+                self.send(200, {'success': True, 'result': result})
+
+            def parse_params(self, query, body):
+                params, files = dict(parse_qsl(query)), {}
+                content_type = self.headers.get('Content-Type', '')
+                if not body:
+                    pass
+                elif content_type.startswith('application/json'):
+                    params.update(json.loads(body))
+                elif content_type.startswith('multipart/form-data'):
+                    message = email.parser.BytesParser().parsebytes(
+                        b'Content-Type: ' + content_type.encode() +
+                        b'\r\n\r\n' + body)
+                    for part in message.get_payload():
+                        name = part.get_param(
+                            'name', header='content-disposition')
+                        filename = part.get_param(
+                            'filename', header='content-disposition')
+                        data = part.get_payload(decode=True)
+                        if filename is None:
+                            params[name] = data.decode()
+                        else:
+                            files[name] = (filename, data)
+                else:
+                    params.update(dict(parse_qsl(body.decode())))
+                return params, files
+
+            def send_file(self, path):
+                data = ckan.files.get(path)
+                if data is None:
+                    return self.send(404, b'', 'text/plain')
+                etag = '"%s"' % hashlib.md5(data).hexdigest()
+                headers = [('ETag', etag), ('Accept-Ranges', 'bytes')]
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                byte_range = self.headers.get('Range')
+                if byte_range:
+                    start, end = byte_range.split('=', 1)[1].split('-')
+                    start = int(start)
+                    end = min(int(end), len(data) - 1) if end else len(data) - 1
+                    headers.append(('Content-Range', 'bytes %s-%s/%s' % (
+                        start, end, len(data))))
+                    return self.send(206, data[start:end + 1],
+                                     'application/octet-stream', headers)
+                self.send(200, data, 'application/octet-stream', headers)
+
+        return Handler
+
+    # Actions
+
+    def action_status_show(self, params, files):
+        return {'ckan_version': '2.8.2'}
+
+    def action_organization_list(self, params, files):
+        return sorted(self.orgs)
+
+    def action_organization_show(self, params, files):
+        return self.orgs[params['id']]
+
+    def action_organization_create(self, params, files):
+        org = dict(params, id=str(uuid.uuid4()), image_display_url='')
+        org['display_name'] = org.get('title') or org['name']
+        self.orgs[org['name']] = org
+        self.add_revision(groups=[org['name']])
+        return org
+
+    def action_organization_patch(self, params, files):
+        org = self.orgs[params['id']]
+        org.update({k: v for k, v in params.items()
+                    if k not in ('id', 'extras')})
+        if 'image_upload' in files:
+            filename, data = files['image_upload']
+            # CKAN prefixes uploaded images with upload time
+            path = 'img/2020-01-01-101010.123456%s' % filename
+            self.files[path] = data
+            org['image_display_url'] = '%s/files/%s' % (self.url, path)
+        self.add_revision(groups=[org['name']])
+        return org
+
+    def action_package_list(self, params, files):
+        return sorted(p['name'] for p in self._active_packages())
+
+    def action_package_show(self, params, files):
+        if params['id'] not in self.packages:     # looked up by ID
+            for package in self.packages.values():
+                if package['id'] == params['id']:
+                    return package
+        return self.packages[params['id']]
+
+    def action_current_package_list_with_resources(self, params, files):
+        packages = sorted(self._active_packages(),
+                          key=lambda p: p['metadata_modified'], reverse=True)
+        limit = int(params.get('limit', 10))
+        offset = int(params.get('offset', 0))
+        return packages[offset:offset + limit]
+
+    def action_package_search(self, params, files):
+        packages = self._active_packages()
+        fq = params.get('fq', '')
+        if fq.startswith('metadata_modified:['):
+            since = fq[len('metadata_modified:['):].split(' TO ')[0]
+            packages = [p for p in packages
+                        if p['metadata_modified'] >= since.rstrip('Z')]
+        field, order = params.get('sort', 'name asc').split(',')[0].split()
+        packages.sort(key=lambda p: (p[field], p['name']),
+                      reverse=(order == 'desc'))
+        rows = min(int(params.get('rows', 10)), self.rows_max)
+        start = int(params.get('start', 0))
+        return {'count': len(packages), 'results': packages[start:start + rows]}
+
+    def action_package_create(self, params, files):
+        package = dict(params, id=str(uuid.uuid4()), resources=[],
+                       metadata_modified=now(),
+                       organization={'name': params['owner_org']})
+        package.setdefault('state', 'active')
+        self.packages[package['name']] = package
+        for res in params.get('resources') or []:
+            self._add_resource(package, dict(res))
+        self.add_revision(packages=[package['name']])
+        return package
+
+    def action_package_patch(self, params, files):
+        package = self.packages[params['id']]
+        package.update({k: v for k, v in params.items()
+                        if k not in ('id', 'resources')})
+        if 'owner_org' in params:
+            package['organization'] = {'name': params['owner_org']}
+        if 'resources' in params:
+            old = {res['id']: res for res in package['resources']}
+            package['resources'] = []
+            for res in params['resources']:
+                res = dict(res)
+                if res.get('id') in old:
+                    kept = old[res['id']]
+                    if kept['url_type'] == 'upload':
+                        res.update({k: kept[k] for k in (
+                            'url', 'url_type', 'size', 'last_modified')})
+                    res.setdefault('url_type', '')
+                    self._touch_resource(res)
+                    res['package_id'] = package['id']
+                    package['resources'].append(res)
+                else:
+                    self._add_resource(package, res)
+        package['metadata_modified'] = now()
+        self.add_revision(packages=[package['name']])
+        return package
+
+    def action_package_update(self, params, files):
+        package = self.packages[params['id']]
+        params.setdefault('resources', [])
+        for key in list(package):
+            if key not in params and key not in (
+                    'id', 'name', 'organization', 'metadata_modified'):
+                del package[key]
+        return self.action_package_patch(params, files)
+
+    def action_dataset_purge(self, params, files):
+        package = self.packages.pop(params['id'])
+        self.add_revision(packages=[package['name']])
+
+    def action_resource_create(self, params, files):
+        package = self.packages[params['package_id']]
+        res = {k: v for k, v in params.items() if k != 'package_id'}
+        res = self._add_resource(package, res, files.get('upload'))
+        package['metadata_modified'] = now()
+        self.add_revision(packages=[package['name']])
+        return res
+
+    def action_resource_update(self, params, files):
+        package, res = self._find_resource(params['id'])
+        kept = {k: res[k] for k in (
+            'id', 'package_id', 'url', 'url_type', 'size', 'last_modified')
+            if k in res}
+        res.clear()
+        res.update(kept)
+        res.update({k: v for k, v in params.items() if k != 'package_id'})
+        if res['url_type'] == 'upload' and not res.get('url'):
+            res['url'] = kept['url']
+        if 'upload' in files:
+            self._store_upload(res, files['upload'])
+        self._touch_resource(res)
+        package['metadata_modified'] = now()
+        self.add_revision(packages=[package['name']])
+        return res
+
+    def action_resource_patch(self, params, files):
+        package, res = self._find_resource(params['id'])
+        res.update({k: v for k, v in params.items() if k != 'package_id'})
+        if 'upload' in files:
+            self._store_upload(res, files['upload'])
+        self._touch_resource(res)
+        package['metadata_modified'] = now()
+        self.add_revision(packages=[package['name']])
+        return res
+
+    def action_resource_delete(self, params, files):
+        package, res = self._find_resource(params['id'])
+        package['resources'].remove(res)
+        self.add_revision(packages=[package['name']])
+
+    def action_revision_list(self, params, files):
+        revisions = self.revisions
+        if params.get('since_id'):
+            ids = [rev['id'] for rev in revisions]
+            revisions = revisions[ids.index(params['since_id']) + 1:]
+        elif params.get('since_time'):
+            revisions = [rev for rev in revisions
+                         if rev['timestamp'] > params['since_time']]
+        if params.get('sort') != 'time_asc':
+            revisions = revisions[::-1]
+        return [rev['id'] for rev in revisions[:50]]
+
+    def action_revision_show(self, params, files):
+        for rev in self.revisions:
+            if rev['id'] == params['id']:
+                return rev
+        raise KeyError(params['id'])
+
+    def _activity_list(self, activities, params):
+        activities = activities[::-1]   # newest first
+        if params.get('before'):
+            before = datetime.datetime.utcfromtimestamp(
+                float(params['before'])).isoformat()
+            activities = [a for a in activities if a['timestamp'] < before]
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 31))
+        return activities[offset:offset + limit]
+
+    def action_recently_changed_packages_activity_list(self, params, files):
+        return self._activity_list(
+            [a for a in self.activities if 'package' in a['data']], params)
+
+    def action_organization_activity_list(self, params, files):
+        return self._activity_list(
+            [a for a in self.activities
+             if a['data'].get('group', {}).get('name') == params['id']],
+            params)
+
+
+def seed(ckan, orgs, packages, resources, links, upload_size):
+    for o in range(orgs):
+        ckan.add_org('org-%d' % o)
+    for p in range(packages):
+        content = ('%s,' % p).encode()
+        uploads = [{
+            'name': 'data-%d.csv' % r,
+            'data': (content * (upload_size // len(content) + 1))[:upload_size]}
+            for r in range(resources)]
+        urls = [{
+            'name': 'link-%d' % r,
+            'url': 'http://example.com/%d/%d' % (p, r)}
+            for r in range(links)]
+        ckan.add_package('package-%05d' % p, 'org-%d' % (p % orgs),
+                         uploads + urls)
+
+
+def change_packages(ckan, fraction, upload_size):
+    '''Changes metadata of given fraction of packages and file of every
+    second changed package.
+    '''
+    names = sorted(ckan.packages)
+    step = max(1, int(1 / fraction)) if fraction else len(names) + 1
+    for i, name in enumerate(names[::step]):
+        ckan.change_package(name, notes='changed %s' % now())
+        if i % 2 == 0:
+            ckan.change_file(name, os.urandom(upload_size))
+
+
+def drift_packages(ckan, fraction):
+    '''Changes metadata and removes the last resource of given fraction of
+    packages, as if they were edited in target after they were synced.
+    '''
+    names = sorted(ckan.packages)
+    step = max(1, int(1 / fraction)) if fraction else len(names) + 1
+    for name in names[::step]:
+        package = ckan.packages[name]
+        package['resources'] = package['resources'][:-1]
+        ckan.change_package(name, notes='drifted %s' % now())
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        # CKAN versions with activity streams only don't list revisions
+        self.source = FakeCkan(args.source_latency,
+                               revision_ids=args.change_feed != 'activity')
+        self.target = FakeCkan(args.target_latency)
+        self.temp_path = tempfile.mkdtemp(prefix='ckan-sync-bench-')
+        self.results = {}
+
+    def close(self):
+        self.source.stop()
+        self.target.stop()
+        shutil.rmtree(self.temp_path)
+
+    def create_sync(self, **kwargs):
+        return sync.CkanSync(
+            sync.CkanApi(self.source.api_url, 'source-key',
+                         change_feed=self.args.change_feed),
+            sync.CkanApi(self.target.api_url, 'target-key'),
+            temp_path=self.temp_path,
+            workers=self.args.workers,
+            **kwargs)
+
+    def last_change(self):
+        '''Returns cursor of the last change of source.'''
+        revision = self.source.revisions[-1]
+        if self.args.change_feed == 'activity':
+            return revision['timestamp']
+        return revision['id']
+
+    def verify(self):
+        '''Returns list of differences between source and target: missing
+        or extra packages, different metadata, resources or files.
+        '''
+        def file_of(ckan, res):
+            if res['url_type'] != 'upload':
+                return res['url']
+            return ckan.files.get(res['url'].split('/files/', 1)[-1])
+
+        differences = []
+        with self.source.lock, self.target.lock:
+            source = {p['name']: p for p in self.source._active_packages()}
+            target = {p['name']: p for p in self.target._active_packages()}
+            for name in sorted(set(source) ^ set(target)):
+                differences.append('package %s is missing in %s' % (
+                    name, 'target' if name in source else 'source'))
+            for name in sorted(set(source) & set(target)):
+                s_pack, t_pack = source[name], target[name]
+                if sync.PackageMetadata(s_pack) != sync.PackageMetadata(t_pack):
+                    differences.append('metadata of package %s' % name)
+                resources = [[(res.get('name'), res['url_type'],
+                               file_of(ckan, res))
+                              for res in package['resources']]
+                             for ckan, package in ((self.source, s_pack),
+                                                   (self.target, t_pack))]
+                if resources[0] != resources[1]:
+                    differences.append('resources of package %s' % name)
+            for name in sorted(set(self.source.orgs) - set(self.target.orgs)):
+                differences.append('organization %s is missing' % name)
+        return differences
+
+    def measure(self, name, func):
+        for ckan in (self.source, self.target):
+            ckan.reset_counters()
+        if self.args.memory:
+            tracemalloc.reset_peak()
+        start = time.monotonic()
+        func()
+        wall_time = time.monotonic() - start
+        calls = sum(self.source.calls.values()) + sum(self.target.calls.values())
+        result = {
+            'wall_time': wall_time,
+            'api_calls': calls,
+            'api_calls_per_package': calls / max(1, len(self.source.packages)),
+            'bytes_moved': sum(ckan.bytes_in + ckan.bytes_out
+                               for ckan in (self.source, self.target)),
+        }
+        if self.args.memory:
+            result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        self.results[name] = result
+        logging.info('Scenario %s finished in %.2f s', name, wall_time)
+        differences = self.verify()
+        if differences:
+            raise AssertionError('Target differs from source after %s: %s'
+                                 % (name, '; '.join(differences[:10])))
+
+    def run(self):
+        args = self.args
+        logging.info('Seeding source with %s packages', args.packages)
+        seed(self.source, args.orgs, args.packages, args.resources,
+             args.links, args.upload_size)
+        if args.memory:
+            tracemalloc.start()
+
+        self.measure('full_initial', lambda: self.create_sync().sync_full())
+        self.measure('full_unchanged', lambda: self.create_sync().sync_full())
+
+        change_packages(self.source, args.changed, args.upload_size)
+        self.measure('full_changed', lambda: self.create_sync().sync_full())
+
+        # packages changed in target are synced with sync state too, also
+        # when their fingerprints are stored there (by the first sync)
+        state = sync.SyncState(os.path.join(self.temp_path, 'state.sqlite'))
+        for name in ('full_drifted', 'full_drifted_again'):
+            drift_packages(self.target, args.changed)
+            self.measure(name, lambda: self.create_sync(
+                state=state).sync_full())
+
+        since_time = now()
+        since_id = self.last_change()
+        change_packages(self.source, args.changed, args.upload_size)
+        self.measure('incremental', lambda: self.create_sync(
+            since_id=since_id).sync())
+
+        change_packages(self.source, args.changed, args.upload_size)
+        self.measure('packages_only', lambda: self.create_sync(
+            since_time=since_time).sync_packages_only())
+
+        since_id = self.last_change()
+        loop_sync = self.create_sync()
+        work = loop_sync.start_loop()
+
+        def loop_iteration():
+            nonlocal since_id
+            since_id = loop_sync.poll(work, since_id)
+            work.join()
+
+        for i in range(args.loop_iterations):
+            change_packages(self.source, args.changed, args.upload_size)
+            self.measure('loop_iteration_%d' % i, loop_iteration)
+
+        if args.memory:
+            tracemalloc.stop()
+        return self.results
+
+
+def format_value(metric, value):
+    if metric == 'wall_time':
+        return '%.3f s' % value
+    if metric in ('bytes_moved', 'peak_memory'):
+        return '%.1f MiB' % (value / 2 ** 20)
+    if isinstance(value, float):
+        return '%.2f' % value
+    return str(value)
+
+
+def report(results, baseline=None):
+    metrics = [
+        'wall_time',
+        'api_calls',
+        'api_calls_per_package',
+        'bytes_moved',
+        'peak_memory',
+    ]
+    for scenario, result in results.items():
+        print(scenario)
+        for metric in metrics:
+            if metric not in result:
+                continue
+            line = '  %-24s %14s' % (
+                metric, format_value(metric, result[metric]))
+            base = (baseline or {}).get(scenario, {}).get(metric)
+            if base:
+                line += '  (baseline %s, %+.1f %%)' % (
+                    format_value(metric, base),
+                    100.0 * (result[metric] - base) / base)
+            print(line)
+
+
+def main():
+    logformat = '%(asctime)-15s %(levelname)s %(message)s'
+    parser = argparse.ArgumentParser(
+        description='Benchmark of CKAN synchronization',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--orgs', type=int, default=5,
+        help='number of organizations')
+    parser.add_argument('--packages', type=int, default=200,
+        help='number of packages')
+    parser.add_argument('--resources', type=int, default=2,
+        help='number of uploaded resources per package')
+    parser.add_argument('--links', type=int, default=2,
+        help='number of link resources per package')
+    parser.add_argument('--upload-size', type=int, default=64 * 1024,
+        help='size of uploaded files (in bytes)')
+    parser.add_argument('--changed', type=float, default=0.1,
+        help='fraction of packages changed before each scenario but first')
+    parser.add_argument('--source-latency', type=float, default=0.005,
+        help='delay of every request to source (in seconds)')
+    parser.add_argument('--target-latency', type=float, default=0.01,
+        help='delay of every request to target (in seconds)')
+    parser.add_argument('--workers', '-w', type=int, default=1,
+        help='number of organizations/packages synced in parallel')
+    parser.add_argument('--change-feed', choices=sorted(sync.CHANGE_FEEDS),
+        default='revision', help='change feed of source used by incremental'
+                                 ' and loop syncs')
+    parser.add_argument('--loop-iterations', type=int, default=3,
+        help='number of measured sync loop iterations')
+    parser.add_argument('--no-memory', action='store_true',
+        help='do not trace peak memory (tracing slows down the sync)')
+    parser.add_argument('--output', '-o',
+        help='save results as JSON to this file')
+    parser.add_argument('--baseline', '-b',
+        help='compare results with ones saved to this file')
+    parser.add_argument('--verbose', '-v', action='store_true',
+        help='log progress of sync')
+    args = parser.parse_args()
+    args.memory = not args.no_memory
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format=logformat)
+
+    benchmark = Benchmark(args)
+    try:
+        results = benchmark.run()
+    finally:
+        benchmark.close()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as fd:
+            baseline = json.load(fd)['results']
+    report(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump({'args': vars(args), 'results': results}, fd, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,315 @@
 #!/usr/bin/env python3
 
 
+import abc
 import argparse
+import collections
+import concurrent.futures
 import configparser
+import contextlib
 import datetime
+import functools
+import glob
+import hashlib
+import heapq
+import http.server
+import itertools
+import json
 import logging
+import math
 import os
+import queue
+import random
 import re
 import requests
+import shutil
+import sqlite3
 import sys
+import threading
 import time
+import uuid
 
 from urllib.parse import urlparse
 
+try:    # faster decoding of API responses
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+try:    # incremental decoding of large API responses (use_float needs 3.1)
+    import ijson
+    if tuple(int(part) for part in re.findall(
+            r'\d+', getattr(ijson, '__version__', '0'))[:2]) < (3, 1):
+        ijson = None
+except ImportError:
+    ijson = None
+
+
+class Metrics:
+    """Registry of performance metrics (counters, gauges and histograms
+    with labels) exported in Prometheus text format, either by an HTTP
+    server or to a file for node_exporter's textfile collector.
+    Counters listed in `rates` are also exported as average rates per
+    second since the start.
+    """
+    buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+    rates = ('ckan_sync_packages_total', 'ckan_sync_resources_total')
+
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._types = {}
+        self._values = {}
+
+    def _key(self, name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._types.setdefault(name, 'counter')
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._types.setdefault(name, 'gauge')
+            self._values[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._types.setdefault(name, 'histogram')
+            # counts per bucket, sum, count
+            hist = self._values.setdefault(key, [0] * len(self.buckets) + [0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    @staticmethod
+    def _format(name, labels, value, **extra):
+        labels = list(labels) + list(extra.items())
+        if labels:
+            name += '{%s}' % ','.join('%s="%s"' % (k, str(v)
+                .replace('\\', '\\\\').replace('"', '\\"')
+                .replace('\n', '\\n')) for k, v in labels)
+        return '%s %s' % (name, value)
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+            types = dict(self._types)
+        elapsed = max(time.time() - self.started, 1e-9)
+        lines = []
+        for name in sorted(types):
+            lines.append('# TYPE %s %s' % (name, types[name]))
+            for (n, labels), value in values:
+                if n != name:
+                    continue
+                if types[name] != 'histogram':
+                    lines.append(self._format(name, labels, value))
+                    continue
+                for bound, count in zip(self.buckets, value):
+                    lines.append(self._format(
+                        name + '_bucket', labels, count, le=bound))
+                lines.append(self._format(
+                    name + '_bucket', labels, value[-1], le='+Inf'))
+                lines.append(self._format(name + '_sum', labels, value[-2]))
+                lines.append(self._format(name + '_count', labels, value[-1]))
+            if name in self.rates:
+                rate = name[:-len('_total')] + '_per_second'
+                lines.append('# TYPE %s gauge' % rate)
+                for (n, labels), value in values:
+                    if n == name:
+                        lines.append(self._format(rate, labels, value / elapsed))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        '''Writes metrics to file (atomically, for textfile collector).'''
+        with open(path + '.tmp', 'w') as fd:
+            fd.write(self.render())
+        os.replace(path + '.tmp', path)
+
+    def serve(self, port, host=''):
+        '''Serves metrics over HTTP in a background thread.'''
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info('Serving metrics on port %s', port)
+        return server
+
+
+METRICS = Metrics()
+
+
+class Tracer:
+    """Optional tracing of phases of syncing packages, organizations and
+    resources. Spans are recorded only if enabled; they are written in
+    Chrome trace event format (opened by chrome://tracing or Perfetto)
+    and summarized as the slowest items with durations of their phases.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._events = []
+        # (item, phase, duration, bytes, parent item of item spans), items
+        # are (kind, name, target) as syncs to several targets trace the same
+        # items
+        self._spans = []
+
+    @contextlib.contextmanager
+    def span(self, name, kind=None, item=None, target=None, **args):
+        '''Records duration of the with block. A span of other item (kind,
+        name & target) than the enclosing one of the same thread spans the
+        whole item; others are phases of the enclosing item. Yields dict
+        of args of the span, to which the block can add e.g. bytes
+        uploaded.
+        '''
+        if not self.enabled:
+            yield args
+            return
+        stack = self._local.__dict__.setdefault('stack', [(None,) * 3])
+        parent = stack[-1]
+        current = (kind or parent[0], item or parent[1], target or parent[2])
+        stack.append(current)
+        start = time.monotonic()
+        try:
+            yield args
+        finally:
+            duration = time.monotonic() - start
+            stack.pop()
+            with self._lock:
+                self._events.append({
+                    'name': name,
+                    'cat': current[0],
+                    'ph': 'X',
+                    'ts': round((start - self.started) * 1e6),
+                    'dur': round(duration * 1e6),
+                    'pid': os.getpid(),
+                    'tid': threading.get_ident(),
+                    'args': dict(args, item=current[1], target=current[2])})
+                self._spans.append((current, name, duration,
+                                    args.get('bytes', 0),
+                                    parent if current != parent else None))
+
+    def write(self, path):
+        '''Writes recorded spans to file as JSON trace.'''
+        with self._lock:
+            trace = {'traceEvents': list(self._events),
+                     'displayTimeUnit': 'ms'}
+        with open(path + '.tmp', 'w') as fd:
+            json.dump(trace, fd)
+        os.replace(path + '.tmp', path)
+
+    def summary(self, top=10):
+        '''Returns report of top slowest items of every kind, with durations
+        of their phases and bytes uploaded. Downloads through temp_path
+        record their size as 'downloaded' instead, so that it isn't counted
+        twice with the upload of the file.
+        '''
+        totals = collections.Counter()
+        phases = collections.defaultdict(collections.Counter)
+        sizes = collections.Counter()
+        parents = {}
+        with self._lock:
+            spans = list(self._spans)
+        for item, name, duration, size, parent in spans:
+            sizes[item] += size
+            if parent is None:
+                phases[item][name] += duration
+                continue
+            totals[item] += duration
+            if parent[1] is not None:
+                phases[parent][name] += duration
+                parents[item] = parent
+        for item, parent in parents.items():
+            sizes[parent] += sizes[item]
+        # items are labelled by their targets, if there are more of them
+        several = len({item[2] for item in totals}) > 1
+        lines = []
+        for kind in ('package', 'organization', 'resource'):
+            items = [(duration, item) for item, duration in totals.items()
+                     if item[0] == kind]
+            if not items:
+                continue
+            lines.append('Slowest %ss:' % kind)
+            for duration, item in sorted(items, reverse=True)[:top]:
+                details = ', '.join('%s %.2f s' % phase
+                                    for phase in phases[item].most_common())
+                if sizes[item]:
+                    details += '; %.1f MiB' % (sizes[item] / 2 ** 20)
+                lines.append('%10.2f s  %s%s%s' % (
+                    duration, item[1], ' @ %s' % item[2] if several else '',
+                    '  (%s)' % details if details else ''))
+        return '\n'.join(lines)
+
+
+TRACER = Tracer()
+
+
+def map_concurrently(func, items, workers, pool='map'):
+    '''Yields results of func called for every item by a pool of threads,
+    in order of completion. Items are consumed lazily, with at most two
+    items per worker waiting in the queue.
+    Param pool: name of the pool in queue depth metric, as pools may nest.
+    '''
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        pending = set()
+        for item in items:
+            if len(pending) >= 2 * workers:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(func, item))
+            METRICS.set('ckan_sync_queue_depth', len(pending), pool=pool)
+        for future in concurrent.futures.as_completed(pending):
+            yield future.result()
+        METRICS.set('ckan_sync_queue_depth', 0, pool=pool)
+
+
+def batches(items, size):
+    '''Yields lists of up to given number of items of iterable, consuming
+    it lazily.
+    '''
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+# package IDs, which CKAN accepts in place of names
+PACKAGE_ID = re.compile(
+    r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+
+
+def shard_of(package_name, shards):
+    '''Returns shard (0 to shards - 1) of given package by rendezvous
+    hashing of its name, so that only its share of packages moves to other
+    shards when their number changes.
+    '''
+    return max(range(shards), key=lambda shard: hashlib.sha1(
+        ('%s:%s' % (shard, package_name)).encode('utf-8')).digest())
+
 
 class Organization(dict):
     """Copy of CKAN organization dict containing only non-internal attributes
@@ -48,35 +345,36 @@ class PackageMetadata(dict):
     """Copy of CKAN package dict containing only non-internal package metadata
     (i.e., no resources).
     """
+    fields = [
+        'author',
+        'author_email',
+        'frequency',
+        'license_id',
+        'license_link',
+        'license_title',
+        'license_url',
+        'maintainer',
+        'maintainer_email',
+        'name',
+        'notes',
+        'publisher_name',
+        'publisher_uri',
+        'ruian_code',
+        'ruian_type',
+        'schema',
+        'spatial_uri',
+        'state',
+        'temporal_start',
+        'temporal_end',
+        'theme',
+        'title',
+        'url',
+        'version',
+    ]
+
     def __init__(self, package_dict):
         super().__init__()
-        keys = [
-            'author',
-            'author_email',
-            'frequency',
-            'license_id',
-            'license_link',
-            'license_title',
-            'license_url',
-            'maintainer',
-            'maintainer_email',
-            'name',
-            'notes',
-            'publisher_name',
-            'publisher_uri',
-            'ruian_code',
-            'ruian_type',
-            'schema',
-            'spatial_uri',
-            'state',
-            'temporal_start',
-            'temporal_end',
-            'theme',
-            'title',
-            'url',
-            'version',
-        ]
-        self.update({k: package_dict.get(k) for k in keys})
+        self.update({k: package_dict.get(k) for k in self.fields})
         extras = [{k: ed.get(k) for k in ['key', 'value']}
                     for ed in package_dict.get('extras', [])]
         tags = [{k: td.get(k) for k in ['display_name', 'state', 'name']}
@@ -94,6 +392,40 @@ class PackageMetadata(dict):
             if isinstance(v, str):
                 self[k] = v.strip()
 
+    @classmethod
+    def compact(cls, package_dict):
+        '''Returns copy of package dict with only the attributes used by
+        sync (metadata, resources and organization name), so that snapshots
+        of large catalogues take less memory.
+        '''
+        keys = cls.fields + ['metadata_modified', 'resources']
+        compact = {k: package_dict[k] for k in keys if k in package_dict}
+        compact.update({
+            'extras': [{k: ed.get(k) for k in ['key', 'value']}
+                       for ed in package_dict.get('extras', [])],
+            'tags': [{k: td.get(k) for k in ['display_name', 'state', 'name']}
+                     for td in package_dict.get('tags', [])],
+            'organization': {'name': package_dict['organization']['name']},
+        })
+        return compact
+
+
+class PackageSnapshot(dict):
+    """Compact package dicts of CKAN instance by their names (see
+    CkanApi.snapshot_packages), with the number of packages reported by
+    package_search while they were fetched.
+    """
+    def __init__(self, packages=(), count=None):
+        super().__init__(packages)
+        self.count = count
+        # number of fetched packages, including ones left out by shard
+        self.fetched = len(self)
+
+    @property
+    def complete(self):
+        '''Whether all packages reported by search were fetched.'''
+        return self.count is None or self.fetched >= self.count
+
 
 class Resource(dict):
     """Dict representing CKAN resource.
@@ -103,6 +435,11 @@ class Resource(dict):
     can't be always simply compared between CKAN instances, therefore
     the 'hash' field of synced target repository is used for storing
     the internal ID & last revision of this resource in source repo.
+
+    For uploaded files, the hash field also holds SHA-256 digest of the file
+    and its last modification time in source repo, so that a file doesn't
+    have to be transferred again when only metadata of resource change:
+    'id:revision#sha256=digest#modified=last_modified'
     """
     def __init__(self, resource_dict, package_name):
         super().__init__()
@@ -111,24 +448,64 @@ class Resource(dict):
         self.update(self.parse_hash())
 
     def parse_hash(self):
+        value, *attrs = (self.get('hash') or '').split('#')
         try:
-            oid, orev = self.get('hash').split(':', 1)
+            oid, orev = value.split(':', 1)
         except ValueError:  # hash is empty
             oid, orev = '', ''
-        return {'original_id': oid, 'original_revision': orev}
+        attrs = dict(attr.split('=', 1) for attr in attrs if '=' in attr)
+        return {
+            'original_id': oid,
+            'original_revision': orev,
+            'original_digest': attrs.get('sha256', ''),
+            'original_modified': attrs.get('modified', ''),
+        }
 
-    def create_hash(self):
-        return '%s:%s' % (self['id'], self['revision_id'])
+    def revision(self):
+        '''Returns version of source resource: its revision_id, which CKAN
+        2.9+ doesn't list, otherwise its modification time or digest
+        of its metadata.
+        '''
+        return (self.get('revision_id') or self.get('metadata_modified') or
+                SnapshotDigest.digest(self))
+
+    def create_hash(self, digest=None):
+        value = '%s:%s' % (self['id'], self.revision())
+        if digest:
+            value += '#sha256=%s#modified=%s' % (
+                digest, self.get('last_modified') or '')
+        return value
 
     def create_filename(self):
         return '%s-%s' % (self['id'], os.path.basename(self['url']))
 
     def same_as_source(self, source_res):
         return (self['original_id'] == source_res['id']) and \
-               (self['original_revision'] in (source_res['revision_id'],
-                                              source_res['last_modified']))
+               bool(self['original_revision']) and \
+               (self['original_revision'] in (source_res.revision(),
+                                              source_res.get('last_modified')))
 
-    def for_upload(self):
+    def same_file_as_source(self, source_res):
+        '''Whether the uploaded file is unchanged in source repo, i.e. its
+        modification time or hash equals the ones stored with its digest.
+        '''
+        if not self['original_digest']:
+            return False
+        if source_res.get('last_modified'):
+            return source_res['last_modified'] == self['original_modified']
+        return source_res.get('hash') in (
+            self['original_digest'], 'sha256:' + self['original_digest'])
+
+    def source_digest(self):
+        '''SHA-256 digest of the file given in hash field of source
+        resource, if there is one.
+        '''
+        value = (self.get('hash') or '').lower()
+        if value.startswith('sha256:'):
+            value = value[len('sha256:'):]
+        return value if re.match(r'^[0-9a-f]{64}$', value) else None
+
+    def for_upload(self, digest=None):
         upload_dict = {k: self.get(k) for k in [
             'describedBy',
             'describedByType',
@@ -142,35 +519,399 @@ class Resource(dict):
             'temporal_end',
         ]}
         upload_dict['url'] = '' if self['url_type'] == 'upload' else self['url']
-        upload_dict['hash'] = self.create_hash()
+        upload_dict['hash'] = self.create_hash(digest)
         return upload_dict
 
 
+class StreamedUpload:
+    """Multipart/form-data request body, which uploads a file streamed from
+    an HTTP response, so that the download and the upload overlap and only
+    one chunk is held in memory at a time.
+
+    Form fields are set by CkanApi.api_action. Fields with callable values
+    are sent after the file; they are called with hex SHA-256 digest of the
+    file, which is computed during the upload. The body is sent with
+    Content-Length when the source response has a known length, with chunked
+    transfer encoding otherwise (len() of 0 makes requests choose that).
+    """
+    chunk_size = 65536
+
+    def __init__(self, field_name, filename, response):
+        self.field_name = field_name
+        self.filename = filename
+        self.response = response
+        self.fields = {}
+        self.digest = hashlib.sha256()
+        # bytes of the file sent so far
+        self.size = 0
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % self.boundary
+
+    def _header(self, name, filename=None):
+        quote = lambda value: value.replace('"', '%22')
+        header = '--%s\r\nContent-Disposition: form-data; name="%s"' % (
+            self.boundary, quote(name))
+        if filename is not None:
+            header += '; filename="%s"\r\n' % quote(filename)
+            header += 'Content-Type: application/octet-stream'
+        return (header + '\r\n\r\n').encode('utf-8')
+
+    def _fields(self, digest=None):
+        '''Yields encoded fields; the ones sent after the file if digest
+        is given.
+        '''
+        for name, value in self.fields.items():
+            if callable(value) != (digest is not None):
+                continue
+            if digest is not None:
+                value = value(digest)
+            if value is not None:
+                yield self._header(name) + str(value).encode('utf-8') + b'\r\n'
+
+    def _file_header(self):
+        return self._header(self.field_name, self.filename)
+
+    def _trailer(self):
+        return ('\r\n--%s--\r\n' % self.boundary).encode('utf-8')
+
+    def __bool__(self):
+        return True
+
+    def __len__(self):
+        # decoded content length is unknown for compressed responses
+        if 'Content-Encoding' in self.response.headers:
+            return 0
+        file_length = int(self.response.headers.get('Content-Length', 0))
+        if not file_length:
+            return 0
+        # length of hex digest is constant
+        fields = list(self._fields()) + list(self._fields('0' * 64))
+        return (sum(len(field) for field in fields) +
+                len(self._file_header()) + file_length + len(self._trailer()))
+
+    def __iter__(self):
+        yield from self._fields()
+        yield self._file_header()
+        for chunk in self.response.iter_content(self.chunk_size):
+            self.digest.update(chunk)
+            self.size += len(chunk)
+            yield chunk
+        yield b'\r\n'
+        yield from self._fields(self.digest.hexdigest())
+        yield self._trailer()[2:]
+
+    def count_bytes(self):
+        '''Counts bytes of the completed upload (and of its download, unless
+        the file is local) in metrics. Bytes of rejected uploads are not
+        counted, as their file is transferred again.
+        '''
+        if not isinstance(self.response, FileContent):
+            METRICS.inc('ckan_sync_downloaded_bytes_total', self.size)
+        METRICS.inc('ckan_sync_uploaded_bytes_total', self.size)
+
+    def close(self):
+        self.response.close()
+
+
+class FileContent:
+    """Local file with the interface of streamed requests.Response used by
+    StreamedUpload, so that large downloaded files are uploaded without
+    being read into memory. Its hex SHA-256 digest may be given.
+    """
+    def __init__(self, path, digest=None):
+        self.fd = open(path, 'rb')
+        self.size = os.path.getsize(path)
+        self.digest = digest
+        self.headers = {'Content-Length': str(self.size)}
+
+    def iter_content(self, chunk_size):
+        return iter(lambda: self.fd.read(chunk_size), b'')
+
+    def close(self):
+        self.fd.close()
+
+
+class TokenBucket:
+    """Rate limiter allowing given number of requests per second on average,
+    with bursts of up to given number of requests. Shared by threads.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AimdLimiter:
+    """Limits number of concurrent requests to a server. The limit is halved
+    (at most once per second) when the server is overloaded, i.e. responds
+    with 429/5xx or times out, and it's increased by one per `limit`
+    successful requests while their latency stays below twice the lowest
+    latency seen. Shared by threads.
+    """
+    def __init__(self, max_limit):
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.active = 0
+        self.min_latency = None
+        self.decreased = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.active >= int(self.limit):
+                self._cond.wait()
+            self.active += 1
+
+    def release(self, overloaded, latency):
+        with self._cond:
+            self.active -= 1
+            now = time.monotonic()
+            if overloaded:
+                if now - self.decreased > 1:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.decreased = now
+                    logging.info('Server overloaded; limiting to %s'
+                                 ' concurrent requests', int(self.limit))
+            else:
+                if self.min_latency is None or latency < self.min_latency:
+                    self.min_latency = latency
+                if latency <= 2 * self.min_latency:
+                    self.limit = min(self.max_limit,
+                                     self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
 class CkanApi:
     """CKAN API wrapper.
+
+    All HTTP requests go through CkanApi.request, which applies timeouts,
+    optional rate (requests per second) & concurrency limits shared by all
+    clones of the wrapper, and retries idempotent requests.
     """
-    def __init__(self, api_url, api_key=None):
+    def __init__(self, api_url, api_key=None, fetch_workers=8,
+                 timeout=300, connect_timeout=10, retries=3, backoff=1,
+                 rate_limit=None, burst=None, max_concurrency=None,
+                 pool_size=10, change_feed='revision', org_poll_interval=600):
         self.api_url = api_url
         self.api_key = api_key
+        # number of parallel requests when fetching details of many items
+        self.fetch_workers = int(fetch_workers)
+        # moving average of duration of read requests (in seconds)
+        self.latency = None
+        self.timeout = (float(connect_timeout), float(timeout))
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+        self.pool_size = int(pool_size)
+        self.rate_limiter = TokenBucket(
+            float(rate_limit), burst and int(burst)) if rate_limit else None
+        self.concurrency = AimdLimiter(
+            int(max_concurrency)) if max_concurrency else None
         self.session = requests.Session()
         self.session.headers.update({
-            'Authorization': self.api_key,
             'User-Agent': 'ckan-sync',
         })
+        # pools of pool_size connections for each of up to 10 hosts
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # source of incremental changes (see ChangeFeed)
+        if change_feed not in CHANGE_FEEDS:
+            raise ValueError('Unknown change feed %s, expected one of: %s'
+                             % (change_feed, ', '.join(CHANGE_FEEDS)))
+        self.change_feed = change_feed
+        self.feed = CHANGE_FEEDS[change_feed](self)
+        # seconds between polls of changes of all organizations (if the feed
+        # lists them by organization)
+        self.org_poll_interval = float(org_poll_interval)
 
     def __str__(self):
         return "<CkanApi %s>" % self.api_url
 
+    def clone(self):
+        """Returns new wrapper of the same CKAN instance with its own session
+        (and therefore its own connection pool), e.g. for a worker thread.
+        Rate & concurrency limits and the change feed are shared with
+        the clone.
+        """
+        api = CkanApi(
+            self.api_url,
+            self.api_key,
+            fetch_workers=self.fetch_workers,
+            timeout=self.timeout[1],
+            connect_timeout=self.timeout[0],
+            retries=self.retries,
+            backoff=self.backoff,
+            pool_size=self.pool_size,
+            change_feed=self.change_feed,
+            org_poll_interval=self.org_poll_interval)
+        api.feed = self.feed
+        api.rate_limiter = self.rate_limiter
+        api.concurrency = self.concurrency
+        api.latency = self.latency
+        return api
+
+    def request(self, method, url, retry=None, measure_body=False,
+                **kwargs):
+        '''Sends HTTP request, returns requests.Response.
+        Idempotent requests (by default GET ones) are retried on connection
+        errors, timeouts, 429 and 5xx responses, with exponential backoff
+        and random jitter.
+        Param measure_body: the request of a streamed response is finished
+        by calling its finish() once the body is read (instead of when its
+        headers arrive), which releases its concurrency slot and returns
+        its duration.
+        '''
+        if retry is None:
+            retry = (method == 'GET')
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.retries + 1):
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            if self.concurrency:
+                self.concurrency.acquire()
+            start, r, overloaded = time.monotonic(), None, True
+            try:
+                r = self.session.request(method, url, **kwargs)
+                overloaded = (r.status_code == 429) or (r.status_code >= 500)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.finish(start, overloaded)
+                if not retry or attempt == self.retries:
+                    raise
+                error = e
+            except BaseException:
+                self.finish(start, overloaded)
+                raise
+            if r is not None:
+                if not (overloaded and retry and attempt < self.retries):
+                    if measure_body:
+                        r.finish = functools.partial(
+                            self.finish, start, overloaded)
+                    else:
+                        self.finish(start, overloaded)
+                    return r
+                self.finish(start, overloaded)
+                error = 'HTTP %s' % r.status_code
+                retry_after = r.headers.get('Retry-After', '')
+                r.close()
+            delay = random.uniform(0, self.backoff * 2 ** attempt)
+            if r is not None and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            logging.warning('Request %s %s failed (%s); retrying in %.1f s',
+                            method, url, error, delay)
+            time.sleep(delay)
+
+    def finish(self, start, overloaded=False):
+        '''Finishes request started at given (monotonic) time, returns its
+        duration.
+        '''
+        duration = time.monotonic() - start
+        if self.concurrency:
+            self.concurrency.release(overloaded, duration)
+        return duration
+
     def api_action(self, action, **kwargs):
+        start = time.monotonic()
+        status = 'error'
+        try:
+            result = self._api_action(action, **kwargs)
+            status = 'ok'
+            return result
+        finally:
+            # streamed responses are recorded once read (see iter_results)
+            if not (kwargs.get('stream') and status == 'ok'):
+                self.record_action(action, status, time.monotonic() - start)
+
+    def record_action(self, action, status, duration):
+        instance = urlparse(self.api_url).netloc
+        METRICS.inc('ckan_sync_api_requests_total',
+                    instance=instance, action=action, status=status)
+        METRICS.observe('ckan_sync_api_request_duration_seconds',
+                        duration, instance=instance, action=action)
+
+    def _api_action(self, action, **kwargs):
         url = '/'.join([self.api_url.strip('/'), 'action', action])
+        kwargs['headers'] = {'Authorization': self.api_key}
+        if isinstance(kwargs.get('files'), StreamedUpload):
+            upload = kwargs.pop('files')
+            upload.fields = kwargs.pop('data')
+            kwargs['data'] = upload
+            kwargs['headers']['Content-Type'] = upload.content_type
+        stream = kwargs.pop('stream', False)
         if ('json' in kwargs) or ('data' in kwargs):
-            r = self.session.post(url=url, **kwargs)
+            r = self.request('POST', url, **kwargs)
             r.raise_for_status()
-            if not r.json().get('success'):
+            result = json_loads(r.content)
+            if not result.get('success'):
                 raise Exception('POST request failed', r.text)
+            return result
+        start = time.monotonic()
+        r = self.request('GET', url, stream=stream, measure_body=stream,
+                         **kwargs)
+        if not stream:
+            self.update_latency(time.monotonic() - start)
+        elif r.status_code >= 400:
+            r.finish()
+            r.close()
+        if r.status_code >= 500 or (stream and r.status_code >= 400):
+            r.raise_for_status()    # no JSON error response
+        return r if stream else json_loads(r.content)
+
+    def iter_results(self, action, meta=None, **kwargs):
+        '''Yields items of 'results' list in result of given read action
+        (like package_search). If ijson is installed, the response is
+        decoded incrementally, so that it's never held in memory whole.
+        Param meta: optional dict, to which 'count' of the result (number
+        of all matching items) is set once the items are yielded.
+        '''
+        if ijson is None:
+            result = self.api_action(action, **kwargs)['result']
+            yield from result['results']
+            if meta is not None:
+                meta['count'] = result.get('count')
+            return
+        start = time.monotonic()
+        r = self.api_action(action, stream=True, **kwargs)
+        status = 'error'
+        try:
+            r.raw.decode_content = True
+            events = ijson.parse(r.raw, use_float=True)
+            if meta is not None:
+                events = self._watch_count(events, meta)
+            yield from ijson.items(events, 'result.results.item')
+            status = 'ok'
+        finally:
+            r.close()
+            # measured once the body is read
+            self.update_latency(r.finish())
+            self.record_action(action, status, time.monotonic() - start)
+
+    @staticmethod
+    def _watch_count(events, meta):
+        for prefix, event, value in events:
+            if prefix == 'result.count':
+                meta['count'] = value
+            yield prefix, event, value
+
+    def update_latency(self, duration):
+        if self.latency is None:
+            self.latency = duration
         else:
-            r = self.session.get(url=url, **kwargs)
-        return r.json()
+            self.latency = 0.8 * self.latency + 0.2 * duration
 
     # Organizations
 
@@ -202,6 +943,56 @@ class CkanApi:
         return self.api_action(
             'package_show', params={'id': package_name}).get('result')
 
+    def count_packages(self):
+        params = {'rows': 0, 'include_private': bool(self.api_key)}
+        return self.api_action('package_search', params=params)['result']['count']
+
+    def search_packages(self, rows=1000, meta=None, **params):
+        '''Yields full package dicts (including private ones if the API key
+        is set) matching given package_search params, fetched in pages
+        of up to given number of rows. CKAN may return fewer rows per page
+        (ckan.search.rows_max), so pages advance by the number of received
+        packages until the count of matching ones is reached.
+        Param meta: optional dict, to which 'count' of matching packages
+        reported by the last page is set.
+        '''
+        params.update({'rows': rows, 'include_private': bool(self.api_key)})
+        meta = {} if meta is None else meta
+        start = 0
+        while True:
+            params['start'] = start
+            received = 0
+            for package in self.iter_results(
+                    'package_search', meta, params=dict(params)):
+                received += 1
+                yield package
+            start += received
+            if received == 0 or start >= (meta.get('count') or 0):
+                break
+
+    def snapshot_packages(self, rows=1000, shard=None):
+        '''Returns PackageSnapshot of all package dicts with resources,
+        using bulk package_search calls instead of package_show per package.
+        Param shard: optional (index, number of shards); only packages of
+        that shard (see shard_of) are kept.
+        '''
+        logging.info('Fetching snapshot of packages from %s', self)
+        meta = {}
+        snapshot = PackageSnapshot()
+        for package in self.search_packages(
+                rows, meta, q='*:*', sort='name asc'):
+            snapshot.fetched += 1
+            if shard and shard_of(package['name'], shard[1]) != shard[0]:
+                continue
+            snapshot[package['name']] = PackageMetadata.compact(package)
+        snapshot.count = meta.get('count')
+        logging.info('Fetched %s packages from %s, kept %s', snapshot.fetched,
+                     self, len(snapshot))
+        if not snapshot.complete:
+            logging.warning('Snapshot of %s is incomplete: %s packages '
+                            'reported by search', self, snapshot.count)
+        return snapshot
+
     def create_package(self, package_dict):
         logging.info('Creating package %(name)s' % package_dict)
         if 'owner_org' not in package_dict.keys():
@@ -233,240 +1024,1984 @@ class CkanApi:
         return self.api_action(
             'resource_update', **{datakey: resource_dict, 'files': files})
 
+    def patch_resource(self, resource_dict):
+        assert 'id' in resource_dict.keys()
+        logging.info('Patching resource %(id)s' % resource_dict)
+        return self.api_action('resource_patch', json=resource_dict)
+
     def delete_resource(self, resource_id):
         logging.info('Deleting resource %s', resource_id)
         return self.api_action('resource_delete', json={'id': resource_id})
 
-    # Revisions
+    # Changes
 
     def get_revision(self, revid):
         return self.api_action(
             'revision_show', params={'id': revid}).get('result')
 
     def collect_revisions(self, since_time=None, since_id=None):
-        # CKAN behavior: if both params given, only since_id is used
-        if not (since_time or since_id):
-            raise ValueError('Cannot collect revisions'
-             ' - missing required param (since_id or since_time)')
-        logging.info('Collecting revisions since %s', since_id or since_time)
+        '''Returns list of changes (revisions or activities, depending on
+        self.feed) since given time or change cursor, oldest first.
+        '''
+        logging.info('Collecting changes since %s', since_id or since_time)
         revisions = []
-        params = {
-            'sort': 'time_asc',
-            'since_id': since_id,
-            'since_time': since_time}
-        batch = self.api_action('revision_list', params=params)['result']
-        while len(batch) > 0:
+        for batch in self.feed.iter_batches(since_time, since_id):
             revisions.extend(batch)
-            params = {'sort': 'time_asc', 'since_id': batch[-1]}
-            batch = self.api_action('revision_list', params=params)['result']
-        logging.info('Found %s revisions', len(revisions))
+        logging.info('Found %s changes', len(revisions))
         return revisions
 
-    def collect_changes_from_revisions(self, revision_list):
+    def collect_changes(self, since_time=None, since_id=None, timestamps=None):
+        '''Collects changes since given time or change cursor and
+        organizations and packages affected by them. Pages of the change
+        feed are fetched while details of already listed changes are fetched.
+        Param timestamps: optional list to which times of changes are
+        appended.
+        Returns (changes, orgs, packages).
+        '''
+        logging.info('Collecting changes since %s', since_id or since_time)
+        revisions = []
+
+        def iter_revisions():
+            for batch in self.feed.iter_batches(since_time, since_id):
+                revisions.extend(batch)
+                yield from batch
+
+        orgs, packages = self.collect_changes_from_revisions(
+            iter_revisions(), timestamps)
+        logging.info('Found %s changes', len(revisions))
+        return (revisions, orgs, packages)
+
+    def collect_changes_from_revisions(self, revision_list, timestamps=None):
         '''Collects changes of both organizations and packages (including
-        deletions), but needs to check every revision, hence suitable only
-        for short term checks/small number of revisions.
+        deletions) from given list of changes of self.feed.
+        Param timestamps: optional list to which times of changes are
+        appended.
         '''
-        logging.info('Collecting changes from revision list.')
-        orgs = set()
-        packages = set()
-        for rev in revision_list:
-            rev_details = self.get_revision(rev)
-            orgs.update(rev_details['groups'])
-            packages.update(rev_details['packages'])
+        orgs, packages = self.feed.changes_of(revision_list, timestamps)
         logging.info(
-            'Found revisions of these organizations: %s and packages: %s',
+            'Found changes of these organizations: %s and packages: %s',
             orgs, packages)
         return (orgs, packages)
 
-    def collect_changed_packages(self, since_time):
-        '''Collects packages created/updated since given time,
-        without deleted ones.
-        Returns list of full package dicts as returned by CKAN API.
-        '''
-        def convert_time(timestamp):
-            time_tuple = re.split('[^\d]+', timestamp)
-            return datetime.datetime(*map(int, time_tuple))
+    def collect_changed_packages(self, since_time, rows=1000):
+        '''Yields packages created/updated since given time (oldest first),
+        without deleted ones, as full package dicts returned by CKAN API.
 
-        def filter_changed_packages(package_list, since_datetime):
-            return [pack for pack in package_list
-                if (convert_time(pack['metadata_modified']) > since_datetime)]
+        The time filter is applied by package_search. Pages are requested
+        by the modification time of the last package seen rather than by
+        offset, so that packages modified during the scan are not skipped.
+        As CKAN may cap the number of rows, the scan ends when all packages
+        counted by the last query were received, not on a short page.
+        '''
+        def solr_time(timestamp):
+            # Solr stores times with millisecond precision
+            return timestamp[:23] + 'Z'
 
         logging.info('Collecting packages changed since %s', since_time)
-        changed_packages = []
-        action = 'current_package_list_with_resources'
-        limit, offset = 20, 0
-        since_datetime = convert_time(since_time)
-        batch = self.api_action(
-            action, params={'limit': limit})['result']
-        packs = filter_changed_packages(batch, since_datetime)
-        changed_packages.extend(packs)
-        while len(packs) == limit:
-            offset += limit
-            batch = self.api_action(
-                action, params={'limit': limit, 'offset': offset})['result']
-            packs = filter_changed_packages(batch, since_datetime)
-            changed_packages.extend(packs)
-        logging.info('Found %s changed packages', len(changed_packages))
-        return changed_packages
-
+        since, skip, count = solr_time(since_time), 0, 0
+        params = {
+            'q': '*:*',
+            'sort': 'metadata_modified asc, name asc',
+            'rows': rows,
+            'include_private': bool(self.api_key)}
+        while True:
+            params.update({
+                'fq': 'metadata_modified:[%s TO *]' % since,
+                'start': skip})
+            batch, start, meta = 0, skip, {}
+            for package in self.iter_results(
+                    'package_search', meta, params=dict(params)):
+                batch += 1
+                modified = solr_time(package['metadata_modified'])
+                # packages of the last seen time are returned again
+                # by the next query; count them to skip them
+                if modified == since:
+                    skip += 1
+                else:
+                    since, skip = modified, 1
+                count += 1
+                yield package
+            if batch == 0 or start + batch >= (meta.get('count') or 0):
+                break
+        logging.info('Found %s changed packages', count)
 
     def empty_trash(self):
         parsed_uri = urlparse(self.api_url)
         trash_uri = '{uri.scheme}://{uri.netloc}/ckan-admin/trash'.format(
             uri=parsed_uri)
-        res = requests.get(
+        res = self.request(
+            'GET',
             trash_uri,
             params={'purge-packages': 'purge'},
             headers = {'Authorization': self.api_key})
 
 
+class ChangeFeed(abc.ABC):
+    """Source of incremental changes of CKAN for CkanApi: lists changes since
+    given time or cursor (the last synced change, kept in sync state) and
+    finds organizations and packages affected by them.
+    """
+    # requests needed to find items affected by one change
+    requests_per_change = 0
+
+    def __init__(self, api):
+        self.api = api
+
+    @abc.abstractmethod
+    def iter_batches(self, since_time=None, since_id=None):
+        '''Yields batches of changes (oldest first) since given time
+        or cursor.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def changes_of(self, changes, timestamps=None):
+        '''Returns (orgs, packages) affected by given changes.
+        Param timestamps: optional list to which times of changes are
+        appended.
+        '''
+        raise NotImplementedError
+
+    def cursor(self, change):
+        '''Returns cursor (since_id) of changes following given one.'''
+        return change
+
+    @abc.abstractmethod
+    def latest(self):
+        '''Returns cursor of the latest change.'''
+        raise NotImplementedError
+
+
+class RevisionFeed(ChangeFeed):
+    """Changes listed by revision_list API (removed in CKAN 2.9). Changes
+    are revision IDs, details of every revision have to be fetched to find
+    its items.
+    """
+    requests_per_change = 1
+
+    def iter_batches(self, since_time=None, since_id=None):
+        '''Yields batches of revision IDs (oldest first) since given time
+        or revision. The next batch is fetched in background while the
+        current one is being processed.
+        '''
+        # CKAN behavior: if both params given, only since_id is used
+        if not (since_time or since_id):
+            raise ValueError('Cannot collect revisions'
+             ' - missing required param (since_id or since_time)')
+        fetcher = self.api.clone()
+        list_revisions = lambda params: fetcher.api_action(
+            'revision_list', params=params)['result']
+        params = {
+            'sort': 'time_asc',
+            'since_id': since_id,
+            'since_time': since_time}
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            batch = list_revisions(params)
+            while len(batch) > 0:
+                params = {'sort': 'time_asc', 'since_id': batch[-1]}
+                next_batch = executor.submit(list_revisions, params)
+                yield batch
+                batch = next_batch.result()
+
+    def changes_of(self, changes, timestamps=None):
+        '''Fetches details of given revisions by api.fetch_workers parallel
+        requests.
+        '''
+        orgs = set()
+        packages = set()
+        local = threading.local()
+
+        def get_revision(revid):
+            if not hasattr(local, 'api'):
+                local.api = self.api.clone()
+            return local.api.get_revision(revid)
+
+        for rev_details in map_concurrently(
+                get_revision, changes, self.api.fetch_workers,
+                pool='revision_show'):
+            orgs.update(rev_details['groups'])
+            packages.update(rev_details['packages'])
+            if timestamps is not None:
+                timestamps.append(rev_details['timestamp'])
+        return (orgs, packages)
+
+    def latest(self):
+        return self.api.api_action('revision_list')['result'][0]
+
+
+class ActivityFeed(ChangeFeed):
+    """Changes listed by activity streams of current CKAN versions:
+    recently_changed_packages_activity_list for packages and
+    organization_activity_list of every organization, which are swept once
+    per api.org_poll_interval seconds only. Changes are brief activity dicts
+    naming their items, so no more requests are needed.
+
+    Cursor holds timestamps of the last package and organization activity
+    seen, each followed by IDs of activities of that time:
+    'package_time|ids|organization_time|ids'. Activities of the cursor time
+    are listed again (another one might have the same timestamp), skipping
+    the seen ones. A plain timestamp is accepted as a cursor too.
+    """
+    # maximum limit of activity lists in default CKAN configuration
+    page_size = 100
+
+    def __init__(self, api):
+        super().__init__(api)
+        # monotonic time of the last sweep of organizations (the feed is
+        # shared by clones of api)
+        self.last_sweep = None
+
+    @staticmethod
+    def unix_time(timestamp):
+        return datetime.datetime.fromisoformat(timestamp).replace(
+            tzinfo=datetime.timezone.utc).timestamp()
+
+    @staticmethod
+    def parse_cursor(cursor):
+        '''Returns (package time, IDs of its activities, organization time,
+        IDs of its activities) of given cursor.
+        '''
+        parts = cursor.split('|')
+        if len(parts) != 4:
+            return (cursor, set(), cursor, set())
+        ids = lambda value: set(filter(None, value.split(',')))
+        return (parts[0], ids(parts[1]), parts[2], ids(parts[3]))
+
+    def iter_activities(self, action, since, skip=(), **params):
+        '''Yields activities of given list action since given timestamp
+        (newest first, including those of that time), except ones of given
+        IDs. Pages are requested by time of the oldest activity seen (param
+        before of CKAN 2.10+, which is exclusive, so the next page overlaps
+        a bit), or by offset where CKAN ignores it.
+        '''
+        fetcher = self.api.clone()
+        params.update({
+            'limit': self.page_size,
+            'include_hidden_activity': bool(self.api.api_key)})
+        seen = set()
+        while True:
+            page = fetcher.api_action(action, params=params)['result']
+            new = [activity for activity in page if activity['id'] not in seen]
+            for activity in new:
+                if activity['timestamp'] < since:
+                    return
+                seen.add(activity['id'])
+                if activity['id'] not in skip:
+                    yield activity
+            if len(page) < self.page_size:
+                return
+            if 'offset' in params:
+                params['offset'] += len(page)
+            elif new:
+                params['before'] = \
+                    self.unix_time(page[-1]['timestamp']) + 0.001
+            else:   # the same page again, param before is not supported
+                    # (or the whole page is of one millisecond)
+                del params['before']
+                params['offset'] = len(seen)
+
+    def iter_batches(self, since_time=None, since_id=None):
+        '''Yields all activities since given time or cursor as one batch,
+        the last one with the cursor following it. Organizations are swept
+        if api.org_poll_interval passed since the last sweep.
+        '''
+        since = since_id or since_time
+        if not since:
+            raise ValueError('Cannot collect activities'
+             ' - missing required param (since_id or since_time)')
+        package_time, package_ids, org_time, org_ids = self.parse_cursor(since)
+        changes = []
+        for activity in self.iter_activities(
+                'recently_changed_packages_activity_list',
+                package_time, package_ids):
+            package = activity.get('data', {}).get('package', {})
+            changes.append({
+                'id': activity['id'],
+                'timestamp': activity['timestamp'],
+                'package': package.get('name') or activity['object_id']})
+
+        def org_changes(org_name):
+            return [{'id': activity['id'],
+                     'timestamp': activity['timestamp'],
+                     'organization': org_name}
+                    for activity in self.iter_activities(
+                        'organization_activity_list', org_time, org_ids,
+                        id=org_name)
+                    if activity['activity_type'].endswith('organization')]
+
+        sweep = self.last_sweep is None or time.monotonic() - \
+            self.last_sweep >= self.api.org_poll_interval
+        if sweep:
+            started = time.monotonic()
+            for batch in map_concurrently(org_changes,
+                                          self.api.clone().list_organizations(),
+                                          self.api.fetch_workers,
+                                          pool='organization_activity_list'):
+                changes.extend(batch)
+            self.last_sweep = started
+        if not changes:
+            return
+        changes.sort(key=lambda change: change['timestamp'])
+
+        def advance(timestamp, ids, changes):
+            '''Returns time and IDs of the last of given changes.'''
+            if not changes or changes[-1]['timestamp'] < timestamp:
+                return (timestamp, ids)
+            last = changes[-1]['timestamp']
+            if last != timestamp:
+                ids = set()
+            return (last, ids | {change['id'] for change in changes
+                                 if change['timestamp'] == last})
+
+        package_time, package_ids = advance(
+            package_time, package_ids,
+            [change for change in changes if 'package' in change])
+        if sweep:
+            # organizations were swept up to the last change seen at least
+            org_time, org_ids = advance(org_time, org_ids, changes)
+            if package_time > org_time:
+                org_time, org_ids = package_time, {
+                    change['id'] for change in changes
+                    if change['timestamp'] == package_time}
+        changes[-1]['cursor'] = '|'.join((
+            package_time, ','.join(sorted(package_ids)),
+            org_time, ','.join(sorted(org_ids))))
+        yield changes
+
+    def changes_of(self, changes, timestamps=None):
+        orgs = set()
+        packages = set()
+        for change in changes:
+            if 'package' in change:
+                packages.add(change['package'])
+            else:
+                orgs.add(change['organization'])
+            if timestamps is not None:
+                timestamps.append(change['timestamp'])
+        return (orgs, packages)
+
+    def cursor(self, change):
+        return change['cursor']
+
+    def latest(self):
+        activities = self.api.api_action(
+            'recently_changed_packages_activity_list',
+            params={'limit': 1})['result']
+        if activities:
+            return activities[0]['timestamp']
+        return datetime.datetime.min.isoformat()
+
+
+CHANGE_FEEDS = {
+    'revision': RevisionFeed,
+    'activity': ActivityFeed,
+}
+
+
+class SharedSource:
+    """Source CkanApi shared by syncs to several targets.
+
+    Results of read calls are memoized, so that every item is fetched from
+    source once, even when several targets ask for it at the same time;
+    a result is dropped once every target used it. Targets announce files
+    transferred by their plans (see want_file); a file wanted by several
+    targets is downloaded once to temp_path and removed as soon as all of
+    them executed their plans (see release_file), while a file wanted by
+    one target only is streamed by it directly. In loop mode, every poll
+    of changes starts a new generation of shared results (see
+    next_generation), as the items might have changed since. Other
+    attributes are those of the wrapped CkanApi.
+    """
+    # generators (like collect_changed_packages) are not memoized, so that
+    # they keep streaming
+    memoized = (
+        'list_organizations',
+        'get_organization',
+        'list_packages',
+        'get_package',
+        'count_packages',
+        'snapshot_packages',
+        'get_revision',
+        'collect_revisions',
+        'collect_changes',
+        'collect_changes_from_revisions',
+    )
+
+    def __init__(self, api, targets, target=None, _shared=None):
+        self.api = api
+        self.targets = targets      # number of targets sharing the source
+        self.target = target        # name of the target of this instance
+        # memoized results & shared files by their keys
+        self._shared = _shared or {
+            'lock': threading.Lock(), 'results': {}, 'files': {}}
+
+    def __str__(self):
+        return str(self.api)
+
+    def clone(self):
+        return SharedSource(
+            self.api.clone(), self.targets, self.target, self._shared)
+
+    def for_target(self, target):
+        '''Returns SharedSource used by sync to target of given name.'''
+        return SharedSource(self.api.clone(), self.targets, target, self._shared)
+
+    def _once(self, entries, key, call):
+        '''Returns result of call, which is done once for given key. It's
+        dropped once every target used it.
+        '''
+        lock = self._shared['lock']
+        with lock:
+            entry = entries.get(key)
+            owner = entry is None
+            if owner:
+                entry = entries[key] = {
+                    'future': concurrent.futures.Future(), 'targets': set()}
+        if owner:
+            try:
+                entry['future'].set_result(call())
+            except Exception as e:
+                entry['future'].set_exception(e)
+                with lock:
+                    if entries.get(key) is entry:
+                        del entries[key]    # next call tries again
+        result = entry['future'].result()
+        with lock:
+            # a target using the result twice (e.g. on retry) counts once
+            entry['targets'].add(self.target)
+            if len(entry['targets']) >= self.targets and \
+                    entries.get(key) is entry:
+                del entries[key]
+        return result
+
+    def __getattr__(self, name):
+        attr = getattr(self.api, name)
+        if name not in self.memoized:
+            return attr
+
+        def memoized(*args, timestamps=None, **kwargs):
+            def call():
+                result_timestamps = []
+                if 'collect_changes' in name:
+                    kwargs['timestamps'] = result_timestamps
+                return attr(*args, **kwargs), result_timestamps
+            key = json.dumps([name, args, kwargs], sort_keys=True, default=str)
+            result, result_timestamps = self._once(
+                self._shared['results'], key, call)
+            if timestamps is not None:
+                timestamps.extend(result_timestamps)
+            return result
+        return memoized
+
+    @staticmethod
+    def _remove_file(entry):
+        future = entry['future']
+        if future and future.done() and not future.exception():
+            location = future.result()[0]
+            # opened file stays readable
+            if os.path.exists(location):
+                os.remove(location)
+
+    def want_file(self, url):
+        '''Announces that the target is going to transfer file at given URL
+        (once for every call), until it calls release_file.
+        '''
+        with self._shared['lock']:
+            entry = self._shared['files'].setdefault(
+                url, {'future': None, 'wanted': collections.Counter()})
+            entry['wanted'][self.target] += 1
+
+    def release_file(self, url):
+        '''Removes file at given URL, once no target wants it anymore.'''
+        with self._shared['lock']:
+            files = self._shared['files']
+            entry = files.get(url)
+            if entry is None:
+                return
+            entry['wanted'][self.target] -= 1
+            if +entry['wanted']:
+                return
+            del files[url]
+        self._remove_file(entry)
+
+    def shared_file(self, url, download):
+        '''Returns FileContent of file at given URL, which is downloaded by
+        given function (returning its location and hex SHA-256 digest or
+        None) once for all targets wanting it. Returns None if no other
+        target wants the file, so that it's not worth storing.
+        '''
+        lock = self._shared['lock']
+        with lock:
+            entry = self._shared['files'].get(url)
+            if entry is None:
+                return None
+            owner = entry['future'] is None
+            if owner:
+                if not any(count > 0 and target != self.target
+                           for target, count in entry['wanted'].items()):
+                    return None
+                entry['future'] = concurrent.futures.Future()
+            future = entry['future']
+        if owner:
+            try:
+                future.set_result(download())
+            except Exception as e:
+                future.set_exception(e)
+                with lock:
+                    if entry['future'] is future:
+                        entry['future'] = None  # next target tries again
+        location, digest = future.result()
+        if os.path.exists(location):    # unless removed by next_generation
+            return FileContent(location, digest)
+
+    def next_generation(self):
+        '''Starts new generation of shared results, e.g. by a poll of
+        changes: results and files of previous ones are not shared anymore.
+        '''
+        with self._shared['lock']:
+            self._shared['results'].clear()
+        self.remove_files()
+
+    def remove_files(self):
+        '''Removes shared files still wanted by some targets.'''
+        with self._shared['lock']:
+            files = self._shared['files']
+            for entry in files.values():
+                self._remove_file(entry)
+            files.clear()
+
+
+class SyncState:
+    """Persistent state of synchronization kept in SQLite database: last
+    processed source revision, fingerprints of synced source packages and
+    status of resource transfers. Every change is committed immediately,
+    so that a restarted sync resumes where it stopped.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None)
+        self._db.executescript('''
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT);
+            CREATE TABLE IF NOT EXISTS packages (
+                name TEXT PRIMARY KEY,
+                metadata_modified TEXT,
+                fingerprint TEXT,
+                synced TEXT);
+            CREATE TABLE IF NOT EXISTS transfers (
+                resource_id TEXT PRIMARY KEY,
+                package TEXT,
+                revision TEXT,
+                status TEXT,
+                updated TEXT);
+            CREATE TABLE IF NOT EXISTS queue (
+                kind TEXT,
+                name TEXT,
+                PRIMARY KEY (kind, name));
+        ''')
+
+    def __str__(self):
+        return "<SyncState %s>" % self.path
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    @staticmethod
+    def fingerprint(package_dict):
+        '''Digest of synced package metadata & resources.'''
+        content = [
+            PackageMetadata(package_dict),
+            package_dict.get('resources', []),
+            package_dict.get('metadata_modified'),
+        ]
+        return hashlib.sha256(
+            json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, key, default=None):
+        rows = self._execute('SELECT value FROM meta WHERE key = ?', (key,))
+        return rows[0][0] if rows else default
+
+    def set(self, key, value):
+        self._execute(
+            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+            (key, value))
+
+    def get_fingerprint(self, package_name):
+        rows = self._execute(
+            'SELECT fingerprint FROM packages WHERE name = ?', (package_name,))
+        return rows[0][0] if rows else None
+
+    def set_package(self, package_name, metadata_modified, fingerprint):
+        self._execute(
+            'INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?)', (
+                package_name,
+                metadata_modified,
+                fingerprint,
+                datetime.datetime.utcnow().isoformat()))
+
+    def forget_package(self, package_name):
+        self._execute('DELETE FROM packages WHERE name = ?', (package_name,))
+
+    def set_transfer(self, resource, status):
+        self._execute(
+            'INSERT OR REPLACE INTO transfers VALUES (?, ?, ?, ?, ?)', (
+                resource['id'],
+                resource['package_id'],
+                resource.revision(),
+                status,
+                datetime.datetime.utcnow().isoformat()))
+
+    def unfinished_transfers(self):
+        return self._execute(
+            'SELECT resource_id, package FROM transfers WHERE status != ?',
+            ('done',))
+
+    def queue_item(self, kind, name):
+        self._execute('INSERT OR IGNORE INTO queue VALUES (?, ?)', (kind, name))
+
+    def unqueue_item(self, kind, name):
+        self._execute(
+            'DELETE FROM queue WHERE kind = ? AND name = ?', (kind, name))
+
+    def queued_items(self):
+        return self._execute('SELECT kind, name FROM queue')
+
+
+class BlobCache:
+    """Persistent cache of downloaded source files in given directory.
+
+    Files are stored by SHA-256 digest of their content, so that identical
+    files are stored once, and looked up by their URLs together with ETag
+    & Last-Modified validators of their responses, which are revalidated
+    by conditional requests. Least recently used files are evicted when
+    the total size exceeds max_size (in bytes).
+    """
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs('%s/blobs' % path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect('%s/index.sqlite' % path,
+                                   check_same_thread=False,
+                                   isolation_level=None)
+        self._db.executescript('''
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS urls (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                digest TEXT);
+            CREATE TABLE IF NOT EXISTS blobs (
+                digest TEXT PRIMARY KEY,
+                size INTEGER,
+                used REAL);
+        ''')
+
+    def __str__(self):
+        return "<BlobCache %s>" % self.path
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def blob_path(self, digest):
+        return '%s/blobs/%s' % (self.path, digest)
+
+    def conditional_headers(self, url):
+        '''Returns headers of conditional request of given URL, if cached.'''
+        rows = self._execute(
+            'SELECT etag, last_modified FROM urls WHERE url = ?', (url,))
+        headers = {}
+        if rows and rows[0][0]:
+            headers['If-None-Match'] = rows[0][0]
+        if rows and rows[0][1]:
+            headers['If-Modified-Since'] = rows[0][1]
+        return headers
+
+    def open(self, url):
+        '''Returns FileContent of cached file of given URL, or None if it
+        was evicted meanwhile.
+        '''
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT digest FROM urls WHERE url = ?', (url,)).fetchall()
+            if not rows or not os.path.exists(self.blob_path(rows[0][0])):
+                return None
+            self._db.execute('UPDATE blobs SET used = ? WHERE digest = ?',
+                             (time.time(), rows[0][0]))
+            # opened file stays readable even if it's evicted later
+            return FileContent(self.blob_path(rows[0][0]))
+
+    def temp_location(self):
+        return '%s/download-%s' % (self.path, uuid.uuid4().hex)
+
+    def store(self, url, headers, location, digest):
+        '''Moves downloaded file of given URL (with given response headers)
+        from temporary location to the cache.
+        '''
+        etag, modified = headers.get('ETag'), headers.get('Last-Modified')
+        size = os.path.getsize(location)
+        if not (etag or modified) or size > self.max_size:
+            # can't be revalidated, or doesn't fit
+            os.remove(location)
+            return
+        with self._lock:
+            if os.path.exists(self.blob_path(digest)):
+                os.remove(location)
+            else:
+                os.replace(location, self.blob_path(digest))
+            self._db.execute(
+                'INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)',
+                (digest, size, time.time()))
+            self._db.execute(
+                'INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?)',
+                (url, etag, modified, digest))
+            self._evict()
+
+    def _evict(self):
+        total = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+        for digest, size in self._db.execute(
+                'SELECT digest, size FROM blobs ORDER BY used').fetchall():
+            if total <= self.max_size:
+                break
+            self._db.execute('DELETE FROM urls WHERE digest = ?', (digest,))
+            self._db.execute('DELETE FROM blobs WHERE digest = ?', (digest,))
+            if os.path.exists(self.blob_path(digest)):
+                os.remove(self.blob_path(digest))
+            total -= size
+
+
+class CachedDownload:
+    """Streamed response of source file, whose content is also written to
+    BlobCache while it's being read.
+    """
+    def __init__(self, cache, url, response):
+        self.cache = cache
+        self.url = url
+        self.response = response
+        self.headers = response.headers
+        self.location = cache.temp_location()
+
+    def iter_content(self, chunk_size):
+        digest = hashlib.sha256()
+        with open(self.location, 'wb') as fd:
+            for chunk in self.response.iter_content(chunk_size):
+                fd.write(chunk)
+                digest.update(chunk)
+                yield chunk
+        self.cache.store(self.url, self.headers, self.location,
+                         digest.hexdigest())
+
+    def close(self):
+        self.response.close()
+        if os.path.exists(self.location):   # not read completely
+            os.remove(self.location)
+
+
+class SyncPlanner:
+    """Chooses between incremental and full sync by comparing estimated
+    durations of their read requests (writes are the same for both),
+    based on numbers of changed items, size of source catalogue and
+    latency of API calls measured in this or previous run.
+    """
+    def __init__(self, max_revisions=None, max_packages=None,
+                 incremental_factor=1.0, default_latency=0.2):
+        # hard limits, above which full sync is always done
+        self.max_revisions = max_revisions
+        self.max_packages = max_packages
+        # multiplier of incremental cost, > 1 makes full sync preferred
+        self.incremental_factor = incremental_factor
+        self.default_latency = default_latency
+        self._full_cost = None
+
+    def reset(self):
+        '''Forgets estimates of previous run.'''
+        self._full_cost = None
+
+    def latency(self, api, state, name):
+        if api.latency is not None:
+            return api.latency
+        if state and state.get('latency:%s' % name):
+            return float(state.get('latency:%s' % name))
+        return self.default_latency
+
+    def full_cost(self, sync, source_latency, target_latency):
+        if self._full_cost is None:
+            packages = sync.source.count_packages()
+            orgs = len(sync.source.list_organizations())
+            pages = math.ceil(packages / sync.page_size) + 1
+            self._full_cost = (
+                pages * (source_latency + target_latency) +
+                orgs * (source_latency + target_latency) / sync.workers)
+            logging.info('Planner: full sync of %s packages and %s'
+                         ' organizations needs ~%.1f s of reads',
+                         packages, orgs, self._full_cost)
+        return self._full_cost
+
+    def prefers_full(self, sync, revisions, changes=None):
+        '''Returns True if full sync is estimated to be cheaper than
+        the incremental one. Param changes: (orgs, packages) found in
+        revisions, None if their details haven't been fetched yet.
+        '''
+        if self.max_revisions is not None and \
+                len(revisions) > self.max_revisions:
+            logging.info('Planner: %s revisions exceed limit of %s;'
+                         ' choosing full sync',
+                         len(revisions), self.max_revisions)
+            return True
+        source_latency = self.latency(sync.source, sync.state, 'source')
+        target_latency = self.latency(sync.target, sync.state, 'target')
+        if changes is None:
+            # the details of revisions have to be fetched first
+            incremental = len(revisions) * source_latency * \
+                sync.source.feed.requests_per_change / \
+                sync.source.fetch_workers
+            description = '%s revisions to check' % len(revisions)
+        else:
+            orgs, packages = changes
+            if self.max_packages is not None and \
+                    len(packages) > self.max_packages:
+                logging.info('Planner: %s changed packages exceed limit of %s;'
+                             ' choosing full sync',
+                             len(packages), self.max_packages)
+                return True
+            incremental = (len(orgs) + len(packages)) * \
+                (source_latency + target_latency) / sync.workers
+            description = '%s organizations and %s packages changed' % (
+                len(orgs), len(packages))
+        incremental *= self.incremental_factor
+        full = self.full_cost(sync, source_latency, target_latency)
+        logging.info('Planner: %s, incremental sync needs ~%.1f s of reads'
+                     ' (latency: source %.3f s, target %.3f s); choosing %s',
+                     description, incremental, source_latency, target_latency,
+                     'full sync' if incremental > full else 'incremental sync')
+        return incremental > full
+
+
+class SnapshotDigest:
+    """Digests of packages in snapshot of CKAN instance (see
+    CkanApi.snapshot_packages) grouped by their organizations, and digests
+    of the organizations. They are computed from package metadata and
+    source IDs & revisions of resources, so that digests of target packages
+    equal digests of the source packages they were synced from.
+    """
+    def __init__(self, snapshot, is_target=False):
+        self.packages_by_org = {}
+        for package in snapshot.values():
+            org = (package.get('organization') or {}).get('name')
+            self.packages_by_org.setdefault(org, {})[package['name']] = \
+                self.package_digest(package, is_target)
+        self.orgs = {org: self.digest(sorted(packages.items()))
+                     for org, packages in self.packages_by_org.items()}
+
+    @staticmethod
+    def digest(content):
+        return hashlib.sha256(
+            json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def package_digest(cls, package_dict, is_target=False):
+        # metadata_modified is not used, it differs in target
+        resources = []
+        for res in package_dict.get('resources', []):
+            if is_target:
+                res = Resource(res, package_dict['name'])
+                resources.append('%(original_id)s:%(original_revision)s' % res)
+            else:
+                res = Resource(res, package_dict['name'])
+                resources.append('%s:%s' % (res['id'], res.revision()))
+        return cls.digest([PackageMetadata(package_dict), resources])
+
+    def differences(self, other):
+        '''Returns set of names of packages, which differ from other
+        snapshot or are missing in one of them. Only packages of
+        organizations with different digests are compared.
+        '''
+        changed = set()
+        for org in set(self.orgs) | set(other.orgs):
+            if self.orgs.get(org) == other.orgs.get(org):
+                continue
+            packages = self.packages_by_org.get(org, {})
+            other_packages = other.packages_by_org.get(org, {})
+            changed.update(
+                name for name in set(packages) | set(other_packages)
+                if packages.get(name) != other_packages.get(name))
+        return changed
+
+
+class PlanGroup(dict):
+    """Operations of SyncPlan changing one organization or package. They
+    depend on each other (a package must exist before its resources are
+    created, resources keep their order), so they are executed in sequence.
+
+    Each operation is a dict with name of the CkanApi write method ('op'),
+    the dict it is called with ('data') and size of the transferred file
+    in bytes ('size'); resource uploads also hold the source resource.
+    """
+    def __init__(self, kind, name):
+        super().__init__()
+        self.update({'kind': kind, 'name': name, 'size': 0, 'operations': []})
+
+    def __str__(self):
+        return '%(kind)s %(name)s' % self
+
+    def add(self, op, data, size=0, **attrs):
+        self['operations'].append(dict(attrs, op=op, data=data, size=size))
+        self['size'] += size
+
+
+class SyncPlan:
+    """Write operations making target CKAN the same as source, computed from
+    state of both instances before any of them is executed, grouped by
+    the organization or package they change.
+    """
+    def __init__(self):
+        self.groups = []
+
+    def add(self, group):
+        if group is not None:
+            self.groups.append(group)
+
+    def schedule(self):
+        '''Returns organization groups and package groups to be executed
+        after them; packages with the largest transfers go first, so that
+        a long upload doesn't run alone at the end of a parallel sync.
+        '''
+        orgs = [g for g in self.groups if g['kind'] == 'organization']
+        packages = [g for g in self.groups if g['kind'] == 'package']
+        packages.sort(key=lambda g: g['size'], reverse=True)
+        return orgs, packages
+
+    def summary(self):
+        counts = {}
+        for group in self.groups:
+            for operation in group['operations']:
+                counts[operation['op']] = counts.get(operation['op'], 0) + 1
+        return {
+            'operations': counts,
+            'transfer_bytes': sum(g['size'] for g in self.groups),
+        }
+
+    def as_dict(self):
+        return {
+            'summary': self.summary(),
+            'groups': [g for g in self.groups if g['operations']],
+        }
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+
+class NotificationListener:
+    """HTTP server accepting notifications of changed items from a hook of
+    source CKAN, so that loop mode syncs them without waiting for the next
+    poll of revisions. Notification is a POST request with JSON body like
+    {"organizations": ["org-name"], "packages": ["package-name"]}.
+    """
+    def __init__(self, port, host='127.0.0.1'):
+        self.queue = queue.Queue()
+        listener = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    body = json.loads(self.rfile.read(length) or b'{}')
+                    items = []
+                    for kind in ('organization', 'package'):
+                        names = body.get(kind + 's', [])
+                        # a string would be taken as a list of characters
+                        if not (isinstance(names, list) and all(
+                                isinstance(name, str) for name in names)):
+                            raise ValueError('%ss are not a list of names'
+                                             % kind)
+                        items += [(kind, name) for name in names]
+                except (ValueError, AttributeError, TypeError):
+                    self.send_response(400)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                for item in items:
+                    listener.queue.put(item)
+                METRICS.inc('ckan_sync_notifications_total', len(items))
+                self.send_response(202)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logging.info('Listening for change notifications on %s:%s', host, port)
+
+    def wait(self, timeout):
+        '''Waits up to timeout (in seconds) for notifications, returns lists
+        of notified organizations and packages, including all notifications
+        queued after the first one.
+        '''
+        try:
+            items = [self.queue.get(timeout=max(timeout, 0))]
+        except queue.Empty:
+            return [], []
+        while True:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        orgs = sorted({name for kind, name in items if kind == 'organization'})
+        packages = sorted({name for kind, name in items if kind == 'package'})
+        return orgs, packages
+
+
+class WorkQueue:
+    """Queue of organizations and packages to be synced in loop mode, as
+    (kind, name) items. Repeated changes of an item waiting in the queue
+    are coalesced, and an item changed while it's being synced is queued
+    again once it's done. Items are recorded in sync state until they're
+    synced, so that they survive a restart.
+
+    Items are planned in priority order: organizations first, and packages
+    wait until organizations being synced are done, as they may reference
+    them. Plans with file transfers go to a separate lane, so that
+    transfers of large files don't hold up changes of metadata, and vice
+    versa. Failed items are retried with exponential backoff (see
+    retry_failed) and given up after max_attempts.
+    """
+    def __init__(self, state=None, max_attempts=5, backoff=60):
+        self.state = state
+        self.max_attempts = max_attempts
+        self.backoff = backoff      # seconds before the first retry
+        self._condition = threading.Condition()
+        self._planned = []          # heap of (priority, seq, item)
+        self._transfers = collections.deque()  # (item, PlanGroup)
+        self._seq = itertools.count()
+        self._seqs = {}             # seq of items until they're synced
+        self._queued = set()
+        self._busy = set()          # planned or being synced
+        self._changed = {}          # seq of busy items changed meanwhile
+        self._attempts = {}         # failed attempts of items
+        self._failed = {}           # time of next retry of failed items
+        self._timestamps = collections.deque()  # (seq, change times)
+
+    def _push(self, item, seq=None):
+        if seq is None:
+            seq = next(self._seq)
+        priority = 0 if item[0] == 'organization' else 1
+        heapq.heappush(self._planned, (priority, seq, item))
+        self._seqs[item] = seq
+        self._queued.add(item)
+        self._failed.pop(item, None)
+        self._condition.notify_all()
+
+    def _update_depth(self):
+        METRICS.set('ckan_sync_queue_depth',
+                    len(self._planned) + len(self._transfers),
+                    pool='work_queue')
+        METRICS.set('ckan_sync_failing_items', len(self._attempts))
+
+    def put(self, kind, name):
+        item = (kind, name)
+        with self._condition:
+            if self.state:
+                self.state.queue_item(kind, name)
+            if item in self._busy:
+                self._changed.setdefault(item, next(self._seq))
+            elif item not in self._queued:
+                self._push(item, self._seqs.get(item))    # if failed
+            self._update_depth()
+
+    def _blocked(self):
+        # packages wait for organizations being synced
+        return self._planned[0][0] > 0 and any(
+            kind == 'organization' for kind, _ in self._busy)
+
+    def get(self):
+        '''Waits for the next item to be planned.'''
+        with self._condition:
+            while not self._planned or self._blocked():
+                self._condition.wait()
+            _, _, item = heapq.heappop(self._planned)
+            self._queued.remove(item)
+            self._busy.add(item)
+            self._update_depth()
+            return item
+
+    def put_transfer(self, item, group):
+        with self._condition:
+            self._transfers.append((item, group))
+            self._update_depth()
+            self._condition.notify_all()
+
+    def get_transfer(self):
+        '''Waits for the next planned item with file transfers.'''
+        with self._condition:
+            while not self._transfers:
+                self._condition.wait()
+            transfer = self._transfers.popleft()
+            self._update_depth()
+            return transfer
+
+    def done(self, item, failed=False):
+        with self._condition:
+            self._busy.remove(item)
+            if failed:
+                self._fail(item)
+            else:
+                self._attempts.pop(item, None)
+            if item in self._changed:
+                self._push(item, self._changed.pop(item))
+            elif not failed:
+                del self._seqs[item]
+                if self.state:
+                    self.state.unqueue_item(*item)
+            self._update_depth()
+            self._condition.notify_all()
+
+    def _fail(self, item):
+        attempts = self._attempts.get(item, 0) + 1
+        if attempts < self.max_attempts:
+            self._attempts[item] = attempts
+            self._failed[item] = \
+                time.monotonic() + self.backoff * 2 ** (attempts - 1)
+            return
+        logging.error('Giving up sync of %s %s after %s failed attempts',
+                      item[0], item[1], attempts)
+        METRICS.inc('ckan_sync_items_given_up_total', kind=item[0])
+        del self._attempts[item]
+        del self._seqs[item]
+        if self.state:
+            self.state.unqueue_item(*item)
+
+    def retry_failed(self):
+        '''Queues again failed items, whose backoff has expired.'''
+        now = time.monotonic()
+        with self._condition:
+            for item, retry_time in list(self._failed.items()):
+                if retry_time <= now:
+                    self._push(item, self._seqs[item])
+            self._update_depth()
+
+    def add_timestamps(self, timestamps):
+        '''Keeps given times of changes of items queued so far, until they
+        are synced (see synced_timestamps).
+        '''
+        if timestamps:
+            with self._condition:
+                self._timestamps.append((next(self._seq), timestamps))
+
+    def synced_timestamps(self):
+        '''Returns times of changes kept by add_timestamps, whose items
+        have been synced (or given up) since.
+        '''
+        with self._condition:
+            pending = min(self._seqs.values(), default=math.inf)
+            timestamps = []
+            while self._timestamps and self._timestamps[0][0] < pending:
+                timestamps.extend(self._timestamps.popleft()[1])
+            return timestamps
+
+    def join(self):
+        '''Waits until no item is queued or being synced.'''
+        with self._condition:
+            while self._queued or self._busy:
+                self._condition.wait()
+
+
 class CkanSync:
-    def __init__(self, source, target, since_id=None, since_time=None, temp_path=None):
+    def __init__(self, source, target, since_id=None, since_time=None,
+                 temp_path=None, workers=1, page_size=1000,
+                 stream_uploads=True, state=None, planner=None,
+                 dry_run=False, large_file_size=None, download_segments=4,
+                 shard=None, cache=None):
         self.source = source
         self.target = target
         self.since_id = since_id
         self.since_time = since_time
         self.temp_path = temp_path
-
-    # Synchronization of organizations, packages & resources
-
-    def sync_org(self, org_name):
-        def sync_image():
-            image_file = self.download_file(s_org._image_url, s_org.image_name)
-            files = [('image_upload', open(image_file, 'rb'))]
-            self.target.patch_organization({'name': org_name}, files)
-            os.remove(image_file)
-
-        logging.info('Syncing organization %s', org_name)
-        s_org = Organization(self.source.get_organization(org_name))
-        t_org_full = self.target.get_organization(org_name)
+        self.workers = workers
+        self.page_size = page_size
+        self.stream_uploads = stream_uploads
+        self.state = state
+        self.planner = planner or SyncPlanner()
+        self.dry_run = dry_run
+        self.large_file_size = large_file_size
+        self.download_segments = download_segments
+        # (index, number of shards) of packages synced by this instance
+        self.shard = shard
+        self.cache = cache
+        self.last_plan = None
+        self.errors = []
+        self._errors_lock = threading.Lock()
+        self._local = threading.local()
+
+    def clone(self):
+        """Returns copy of this sync with its own source & target sessions.
+        """
+        return CkanSync(
+            self.source.clone(),
+            self.target.clone(),
+            since_id=self.since_id,
+            since_time=self.since_time,
+            temp_path=self.temp_path,
+            page_size=self.page_size,
+            stream_uploads=self.stream_uploads,
+            state=self.state,
+            dry_run=self.dry_run,
+            large_file_size=self.large_file_size,
+            download_segments=self.download_segments,
+            shard=self.shard,
+            cache=self.cache)
+
+    # Concurrent execution
+
+    def _worker_sync(self):
+        '''Returns CkanSync instance owned by the current worker thread.'''
+        if not hasattr(self._local, 'sync'):
+            self._local.sync = self.clone()
+        return self._local.sync
+
+    def run_concurrently(self, method_name, items, **kwargs):
+        '''Calls given sync method for every item (with optional keyword
+        arguments) using a pool of self.workers threads (or serially in
+        this thread with a single worker), returns list of results of
+        successful calls. Items are consumed lazily, with at most two items
+        per worker waiting in the queue. Failures are logged and collected
+        in self.errors rather than aborting the run.
+        '''
+        def run(item):
+            sync = self._worker_sync() if self.workers > 1 else self
+            try:
+                return getattr(sync, method_name)(item, **kwargs)
+            except Exception as e:
+                label = item['name'] if type(item) == dict else str(item)
+                logging.exception('Failed to sync %s', label)
+                with self._errors_lock:
+                    self.errors.append((label, e))
+
+        if self.workers > 1:
+            results = map_concurrently(run, items, self.workers,
+                                       pool=method_name)
+        else:
+            results = map(run, items)
+        return [result for result in results if result is not None]
+
+    def report_errors(self):
+        '''Logs summary of failed items, returns True if there were any.'''
+        for item, error in self.errors:
+            logging.error('Failed to sync %s: %r', item, error)
+        if self.errors:
+            logging.error('%s items failed to sync', len(self.errors))
+        return bool(self.errors)
+
+    # Planning of organizations, packages & resources
+
+    def plan_org(self, org_name):
+        '''Returns PlanGroup of operations syncing given organization.'''
+        with TRACER.span('plan', 'organization', org_name,
+                         self.target.api_url):
+            with TRACER.span('fetch-source'):
+                s_org = Organization(self.source.get_organization(org_name))
+            org_name = s_org['name'] or org_name    # if given ID
+            with TRACER.span('fetch-target'):
+                t_org_full = self.target.get_organization(org_name)
+            with TRACER.span('diff'):
+                return self.want_files(
+                    self.plan_org_diff(org_name, s_org, t_org_full))
+
+    def plan_org_diff(self, org_name, s_org, t_org_full):
+        '''Returns PlanGroup of operations syncing target organization dict
+        (None if missing) with source Organization.
+        '''
+        group = PlanGroup('organization', org_name)
+        image = {'url': s_org._image_url, 'filename': s_org.image_name}
         if not t_org_full:
-            self.target.create_organization(s_org)
+            group.add('create_organization', s_org)
             # image upload must be done in this extra step, there is collision
             # with processing of organization 'extras' otherwise
-            sync_image()
+            group.add('upload_organization_image', {'name': org_name}, **image)
         else:
             t_org = Organization(t_org_full)
             if s_org != t_org:
-                self.target.patch_organization(s_org)
+                group.add('patch_organization', s_org)
             if s_org.image_name != t_org.image_name:
-                sync_image()
-
-
-    def sync_package(self, package):
-        '''Param package: either full package dict returned by source CKAN,
+                group.add('upload_organization_image', {'name': org_name},
+                          **image)
+        return group
+
+    def plan_package(self, package, target_snapshot=None):
+        '''Returns PlanGroup of operations syncing given package, or None
+        if there is nothing to do.
+        Param package: either full package dict returned by source CKAN,
         or just package name.
+        Param target_snapshot: optional dict of target package dicts by their
+        names (see CkanApi.snapshot_packages); if given, target package is
+        looked up there instead of being fetched from target CKAN.
         '''
-        if type(package) == dict:
-            s_pack = package
-            package_name = s_pack['name']
-        else:
-            package_name = package
-            s_pack = self.source.get_package(package_name)
-        logging.info('Syncing package %s', package_name)
-        t_pack = self.target.get_package(package_name)
-        if s_pack:
-            # metadata
-            s_package_meta = PackageMetadata(s_pack)
-            if not t_pack:
-                self.target.create_package(s_package_meta)
+        package_name = package['name'] if type(package) == dict else package
+        with TRACER.span('plan', 'package', package_name,
+                         self.target.api_url):
+            if type(package) == dict:
+                s_pack = package
             else:
-                if s_package_meta != PackageMetadata(t_pack):
-                    if s_package_meta['state'] == 'deleted':
-                        self.target.purge_package(package_name)
-                        return
-                    else:
-                        self.target.patch_package(s_package_meta)
-            # resources
-            s_resources = s_pack.get('resources', [])
-            t_resources = t_pack.get('resources', []) if t_pack else []
-            self.sync_package_resources(s_resources, t_resources, package_name)
-        else:   # package not found in source CKAN
-            if t_pack:
-                self.target.purge_package(package_name)
+                with TRACER.span('fetch-source'):
+                    s_pack = self.source.get_package(package)
+                package_name = s_pack['name'] if s_pack else package
+                if s_pack and not self.in_shard(s_pack):    # if given ID
+                    return None
+            if s_pack and self.is_unchanged(s_pack, target_snapshot):
+                logging.info('Package %s unchanged since last sync',
+                             package_name)
+                METRICS.inc('ckan_sync_packages_total', result='unchanged')
+                return None
+            if target_snapshot is not None:
+                t_pack = target_snapshot.get(package_name)
             else:
+                with TRACER.span('fetch-target'):
+                    t_pack = self.target.get_package(package_name)
+            if not s_pack:  # package not found in source CKAN
+                if t_pack:
+                    return self.plan_purge(package_name)
                 logging.warning(
                     'Package %s not found in either repo; doing nothing',
                     package_name)
-
-    def sync_package_resources(self, source_reslist, target_reslist, package_name):
-        logging.info('Syncing resources of package %s', package_name)
+                return None
+            with TRACER.span('diff'):
+                return self.want_files(self.plan_package_diff(s_pack, t_pack))
+
+    @staticmethod
+    def transferred_files(group):
+        '''Returns URLs of source files transferred by given PlanGroup.'''
+        urls = []
+        for operation in group['operations']:
+            if 'source' in operation:
+                urls.append(operation['source']['url'])
+            elif operation['op'] == 'upload_organization_image':
+                urls.append(operation['url'])
+        return urls
+
+    def want_files(self, group):
+        '''Announces files transferred by given PlanGroup to SharedSource
+        (see SharedSource.want_file), returns the group.
+        '''
+        if isinstance(self.source, SharedSource) and not self.dry_run:
+            for url in self.transferred_files(group):
+                self.source.want_file(url)
+        return group
+
+    def plan_package_diff(self, s_pack, t_pack):
+        '''Returns PlanGroup of operations syncing target package dict
+        (None if missing) with source one.
+        '''
+        package_name = s_pack['name']
+        group = PlanGroup('package', package_name)
+        # metadata
+        s_package_meta = PackageMetadata(s_pack)
+        if not t_pack:
+            group.add('create_package', s_package_meta)
+        elif s_package_meta != PackageMetadata(t_pack):
+            if s_package_meta['state'] == 'deleted':
+                return self.plan_purge(package_name)
+            group.add('patch_package', s_package_meta)
+        # resources
+        s_resources = s_pack.get('resources', [])
+        t_resources = t_pack.get('resources', []) if t_pack else []
+        self.plan_package_resources(group, s_resources, t_resources)
+        # recorded in sync state once all operations are done
+        group['metadata_modified'] = s_pack.get('metadata_modified')
+        group['fingerprint'] = SyncState.fingerprint(s_pack) \
+            if self.state else None
+        return group
+
+    def plan_purge(self, package_name):
+        group = PlanGroup('package', package_name)
+        group.add('purge_package', {'id': package_name})
+        return group
+
+    def is_unchanged(self, s_pack, target_snapshot=None):
+        '''Whether source package has the same fingerprint as when it was
+        last synced. If target snapshot is given, the target package must
+        also match the source one (by SnapshotDigest), as it might have
+        been changed in target since.
+        '''
+        if not self.state:
+            return False
+        if target_snapshot is not None:
+            t_pack = target_snapshot.get(s_pack['name'])
+            if t_pack is None or SnapshotDigest.package_digest(s_pack) != \
+                    SnapshotDigest.package_digest(t_pack, is_target=True):
+                return False
+        return SyncState.fingerprint(s_pack) == \
+            self.state.get_fingerprint(s_pack['name'])
+
+    def plan_package_resources(self, group, source_reslist, target_reslist):
+        package_name = group['name']
 
         # 1. prepare dict of target resources, where the keys are their
         #    original IDs in source CKAN
         t_resources_by_oid = dict()
+        unmatched = []
         for target_res in target_reslist:
             res = Resource(target_res, package_name)
             oid = res['original_id']
             if len(oid) == 0:
                 # empty hash => resource can't be matched across CKAN instances
-                self.target.delete_resource(res['id'])
+                unmatched.append(res['id'])
             else:
-                t_resources_by_oid[oid] = res
+                t_resources_by_oid[oid] = (res, target_res)
 
-        # 2. process list of resources present in source repo
+        # 2. process list of resources present in source repo; resulting
+        #    target resource list is kept for a package-level write
+        resources, changes = [], []
         for source_res in source_reslist:
-            files = None
             s_res = Resource(source_res, package_name)
-            if s_res['id'] not in t_resources_by_oid:  # create
-                if s_res['url_type'] == 'upload':
-                    downloaded = self.download_file(
-                        s_res['url'], s_res.create_filename())
-                    files = [('upload', open(downloaded, 'rb'))]
-                self.target.create_resource(s_res.for_upload(), files)
+            res_upload = s_res.for_upload()
+            t_res, target_res = t_resources_by_oid.pop(s_res['id'], (None, None))
+            if t_res is None:
+                op, t_digest = 'create_resource', None
             else:
-                t_res = t_resources_by_oid.pop(s_res['id'])
-                if not t_res.same_as_source(s_res):     # update
-                    if s_res['url_type'] == 'upload':
-                        downloaded = self.download_file(
-                            s_res['url'], s_res.create_filename())
-                        files = [('upload', open(downloaded, 'rb'))]
-                    res_upload = s_res.for_upload()
-                    res_upload['id'] = t_res['id']
-                    self.target.update_resource(res_upload, files)
-            if files is not None:
-                os.remove(downloaded)
+                if t_res.same_as_source(s_res):
+                    METRICS.inc('ckan_sync_resources_total',
+                                operation='unchanged')
+                    resources.append(target_res)
+                    continue
+                res_upload['id'] = t_res['id']
+                op, t_digest = 'update_resource', t_res['original_digest']
+                if s_res['url_type'] == 'upload' and \
+                        t_res.same_file_as_source(s_res):
+                    # metadata only, without transferring the unchanged file
+                    del res_upload['url']   # would replace the uploaded file
+                    res_upload['hash'] = s_res.create_hash(t_digest)
+                    resources.append(dict(target_res, **res_upload))
+                    changes.append({'op': 'patch_resource', 'data': res_upload})
+                    continue
+            if s_res['url_type'] == 'upload':
+                # placeholder of new file (with empty hash, so that it's
+                # recreated if the upload fails) or the current one
+                resources.append(target_res or dict(res_upload, hash=''))
+                changes.append({
+                    'op': op, 'data': res_upload,
+                    'size': self.resource_size(s_res),
+                    'source': dict(source_res), 'target_digest': t_digest,
+                    'position': len(resources) - 1})
+            else:
+                resources.append(res_upload)
+                changes.append({'op': op, 'data': res_upload})
+        deletes = unmatched + [t['id'] for t, _ in t_resources_by_oid.values()]
+
+        # 3. write links, metadata of unchanged files and deletions by one
+        #    package call with the whole resource list, if that saves calls
+        #    (files are still uploaded per resource)
+        batched = [c for c in changes if 'source' not in c]
+        package_op = next((o for o in group['operations']
+                           if o['op'] in ('create_package', 'patch_package')),
+                          None)
+        if len(batched) + len(deletes) > (0 if package_op else 1):
+            if package_op is None:
+                group.add('patch_package', {'name': package_name})
+                package_op = group['operations'][-1]
+            package_op['data'] = dict(package_op['data'], resources=resources)
+            counts = {'delete': len(deletes)}
+            for change in batched:
+                operation = change['op'].split('_')[0]
+                counts[operation] = counts.get(operation, 0) + 1
+            package_op['resources'] = counts
+            for change in changes:
+                if 'source' in change:
+                    group.add(change.pop('op'), change.pop('data'),
+                              change.pop('size'), **change)
+            return
+        for resource_id in unmatched:
+            group.add('delete_resource', {'id': resource_id})
+        for change in changes:
+            change.pop('position', None)
+            group.add(change.pop('op'), change.pop('data'),
+                      change.pop('size', 0), **change)
+        for t, _ in t_resources_by_oid.values():
+            group.add('delete_resource', {'id': t['id']})
+
+    @staticmethod
+    def resource_size(s_res):
+        '''Size of resource file in bytes as reported by source CKAN.'''
+        try:
+            return int(s_res.get('size') or 0)
+        except ValueError:
+            return 0
 
-        # 3. delete remaining target resources
-        for t in t_resources_by_oid.values():
-            self.target.delete_resource(t['id'])
+    @property
+    def coordinator(self):
+        '''Whether this sync handles organizations and emptying of trash,
+        i.e. it's not sharded or it's the first shard.
+        '''
+        return not self.shard or self.shard[0] == 0
 
-    def download_file(self, url, filename):
+    def in_shard(self, package):
+        '''Whether given package (dict, name or ID) is synced by this sync.
+        Packages are partitioned by names; ones given by ID (e.g. by change
+        feed or notifications) pass, plan_package checks them once their
+        name is known.
+        '''
+        if not self.shard:
+            return True
+        if type(package) == dict:
+            package = package['name']
+        elif PACKAGE_ID.match(package):
+            return True
+        return shard_of(package, self.shard[1]) == self.shard[0]
+
+    def plan(self, orgs, packages, target_snapshot=None, purges=()):
+        '''Returns SyncPlan of given organizations and packages (and of
+        purging given target packages), limited to the shard of this sync.
+        Only read calls are made here.
+        '''
+        plan = SyncPlan()
+        if not self.coordinator:
+            orgs = []
+        if self.shard:
+            packages = (p for p in packages if self.in_shard(p))
+            purges = [p for p in purges if self.in_shard(p)]
+        groups = self.run_concurrently('plan_org', orgs)
+        groups += self.run_concurrently(
+            'plan_package', packages, target_snapshot=target_snapshot)
+        groups += [self.plan_purge(package) for package in purges]
+        for group in groups:
+            plan.add(group)
+        summary = plan.summary()
+        logging.info('Planned %s operations, %s bytes to transfer: %s',
+                     sum(summary['operations'].values()),
+                     summary['transfer_bytes'], summary['operations'])
+        return plan
+
+    # Execution of planned operations
+
+    def execute(self, plan):
+        orgs, packages = plan.schedule()
+        # all organizations must exist before packages referencing them
+        for groups in (orgs, packages):
+            self.run_concurrently('execute_group', groups)
+
+    def execute_group(self, group):
+        logging.info('Syncing %s', group)
+        package = None
+        try:
+            with TRACER.span('execute', group['kind'], group['name'],
+                             self.target.api_url):
+                for operation in group['operations']:
+                    result = self.execute_operation(group, operation, package)
+                    if operation['op'] in ('create_package', 'patch_package'):
+                        package = result['result']
+        finally:
+            # files announced by planning of the group
+            if isinstance(self.source, SharedSource) and not self.dry_run:
+                for url in self.transferred_files(group):
+                    self.source.release_file(url)
+        if group['kind'] == 'package' and 'fingerprint' in group:
+            if self.state:
+                self.state.set_package(group['name'],
+                                       group['metadata_modified'],
+                                       group['fingerprint'])
+            METRICS.inc('ckan_sync_packages_total', result='synced')
+        return group
+
+    def execute_operation(self, group, operation, package=None):
+        '''Executes planned operation, returns result of its API call.
+        Param package: target package dict returned by the last package
+        write of the group, which holds placeholders of new files.
+        '''
+        op, data = operation['op'], dict(operation['data'])
+        result = None
+        if op == 'upload_organization_image':
+            self.upload_org_image(group['name'], operation['url'],
+                                  operation['filename'])
+        elif 'source' in operation:
+            write = getattr(self.target, op)
+            if 'position' in operation:     # upload to a placeholder
+                data['id'] = package['resources'][operation['position']]['id']
+                write = self.target.update_resource
+            s_res = Resource(operation['source'], group['name'])
+            with TRACER.span('transfer', 'resource', '%s/%s' % (
+                    group['name'], s_res.get('name') or s_res['id']),
+                    self.target.api_url):
+                self.upload_resource(s_res, data, write,
+                                     operation['target_digest'])
+        else:
+            with TRACER.span('write'):
+                if op == 'purge_package':
+                    self.purge_package(data['id'])
+                elif op == 'delete_resource':
+                    self.target.delete_resource(data['id'])
+                else:
+                    result = getattr(self.target, op)(data)
+        if op.endswith('_resource'):
+            METRICS.inc('ckan_sync_resources_total',
+                        operation=op.split('_')[0])
+        for operation_name, count in operation.get('resources', {}).items():
+            METRICS.inc('ckan_sync_resources_total', count,
+                        operation=operation_name)
+        return result
+
+    def sync_org(self, org_name):
+        self.execute_group(self.plan_org(org_name))
+
+    def sync_package(self, package, target_snapshot=None):
+        '''Plans and executes sync of one package, see plan_package.'''
+        group = self.plan_package(package, target_snapshot)
+        if group is not None:
+            self.execute_group(group)
+
+    def purge_package(self, package_name):
+        self.target.purge_package(package_name)
+        METRICS.inc('ckan_sync_packages_total', result='purged')
+        if self.state:
+            self.state.forget_package(package_name)
+
+    def upload_org_image(self, org_name, url, image_name):
+        image_file = self.download_file(url, '%s-%s' % (org_name, image_name))
+        files = [('image_upload', (image_name, open(image_file, 'rb')))]
+        with TRACER.span('upload', bytes=os.path.getsize(image_file)):
+            self.target.patch_organization({'name': org_name}, files)
+        os.remove(image_file)
+
+    def patch_resource_metadata(self, s_res, res_upload, digest):
+        '''Updates target resource without transferring its unchanged file.'''
+        del res_upload['url']   # would replace the uploaded file
+        res_upload['hash'] = s_res.create_hash(digest)
+        with TRACER.span('write'):
+            self.target.patch_resource(res_upload)
+
+    def upload_resource(self, s_res, res_upload, write, t_digest=None):
+        '''Uploads file of source resource using given target write call
+        (create_resource or update_resource) with given resource dict,
+        storing digest of the file in its hash.
+
+        The file is streamed from source directly into the upload. If the
+        streaming is disabled, or the target rejects a chunked upload (of
+        a file with unknown length), the file is downloaded to temp_path
+        first; then its upload is skipped if its digest equals t_digest
+        of the target file.
+        '''
+        if self.state:
+            self.state.set_transfer(s_res, 'started')
+        self.transfer_file(s_res, res_upload, write, t_digest)
+        if self.state:
+            self.state.set_transfer(s_res, 'done')
+
+    def transfer_file(self, s_res, res_upload, write, t_digest=None):
+        filename = s_res.create_filename()
+        if self.large_file_size and \
+                self.resource_size(s_res) >= self.large_file_size:
+            return self.transfer_large_file(s_res, res_upload, write, t_digest)
+        if self.stream_uploads:
+            upload = StreamedUpload('upload', filename,
+                                    self.fetch_file(s_res['url']))
+            try:
+                # download & upload overlap
+                with TRACER.span('stream') as span:
+                    result = write(dict(res_upload, hash=s_res.create_hash),
+                                   upload)
+                    span['bytes'] = upload.size
+                upload.count_bytes()
+                return result
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code != 411:
+                    raise
+                logging.warning('Target requires Content-Length of uploads;'
+                                ' uploading from temporary files instead')
+                self.stream_uploads = False
+            finally:
+                upload.close()
+        digest = hashlib.sha256()
+        downloaded = self.download_file(s_res['url'], filename, digest)
+        try:
+            if digest.hexdigest() == t_digest:
+                return self.patch_resource_metadata(s_res, res_upload, t_digest)
+            res_upload['hash'] = s_res.create_hash(digest.hexdigest())
+            size = os.path.getsize(downloaded)
+            with open(downloaded, 'rb') as fd, \
+                    TRACER.span('upload', bytes=size):
+                result = write(res_upload, [('upload', fd)])
+            METRICS.inc('ckan_sync_uploaded_bytes_total', size)
+            return result
+        finally:
+            os.remove(downloaded)
+
+    def transfer_large_file(self, s_res, res_upload, write, t_digest=None):
+        '''Transfers file of source resource through temp_path. Interrupted
+        downloads are resumed (also in next runs). After a failed upload the
+        downloaded file is kept, so that next attempt uploads it without
+        downloading it again; if that upload fails too, it's removed. With
+        SharedSource, the file is downloaded once for all targets wanting it.
+        '''
+        # partial downloads of other versions of the file are not resumed
+        version = re.sub(r'\W', '', s_res.get('last_modified') or
+                         s_res.revision())
+        filename = '%s-%s' % (version, s_res.create_filename())
+        downloaded, retried = None, False
+        with TRACER.span('download') as span:
+            content = None
+            if isinstance(self.source, SharedSource):
+                content = self.source.shared_file(
+                    s_res['url'], lambda: self.download_large_file(
+                        s_res['url'], 'shared-' + filename))
+            if content is None:
+                retried = os.path.exists('%s/%s' % (self.temp_path, filename))
+                downloaded, digest = self.download_large_file(
+                    s_res['url'], filename)
+                content = FileContent(downloaded, digest)
+            span['downloaded'] = content.size
+        upload = StreamedUpload('upload', s_res.create_filename(), content)
+        try:
+            if s_res.source_digest() not in (None, content.digest):
+                retried = True      # not worth keeping
+                raise ValueError('Digest of %s differs from the one in source'
+                                 ' resource %s' % (s_res['url'], s_res['id']))
+            if content.digest == t_digest:
+                self.patch_resource_metadata(s_res, res_upload, t_digest)
+            else:
+                with TRACER.span('upload', bytes=content.size):
+                    write(dict(res_upload,
+                               hash=s_res.create_hash(content.digest)), upload)
+                upload.count_bytes()
+        except Exception:
+            if downloaded and retried:
+                os.remove(downloaded)
+            raise
+        finally:
+            upload.close()
+        if downloaded:
+            os.remove(downloaded)
+
+    def download_large_file(self, url, filename):
+        '''Downloads file to temp_path, returns its location and hex SHA-256
+        digest. If source supports range requests, the file is downloaded
+        in download_segments parallel segments. Segments are written to .part
+        files, whose downloads are resumed when interrupted (also in next
+        runs); their layout is kept in .parts file, so that parts of another
+        layout (e.g. of another length of the file) are discarded. Size of
+        the downloaded file is verified.
+        '''
         location = '%s/%s' % (self.temp_path, filename)
-        r = requests.get(url)
-        with open(location, 'wb') as fd:
-            for chunk in r.iter_content(4096):
-                fd.write(chunk)
+        head = self.source.request('HEAD', url, retry=True,
+                                   allow_redirects=True)
+        head.raise_for_status()
+        length = int(head.headers.get('Content-Length') or 0)
+        if 'Content-Encoding' in head.headers:  # length of encoded content
+            length = 0
+        if not (length and os.path.exists(location) and
+                os.path.getsize(location) == length):
+            segments = 1
+            if length and head.headers.get('Accept-Ranges') == 'bytes':
+                segments = max(1, min(self.download_segments,
+                                      length // StreamedUpload.chunk_size))
+            bounds = [(length * i // segments, length * (i + 1) // segments - 1)
+                      for i in range(segments)] if segments > 1 else [(0, None)]
+            parts = ['%s.part%s' % (location, i) for i in range(segments)]
+            self.prepare_parts(location, {'length': length, 'bounds': bounds})
+            with concurrent.futures.ThreadPoolExecutor(segments) as executor:
+                futures = [
+                    executor.submit(self.download_segment, url, part, *bound)
+                    for part, bound in zip(parts, bounds)]
+                for future in futures:
+                    future.result()
+            with open(location, 'wb') as fd:
+                for part in parts:
+                    with open(part, 'rb') as part_fd:
+                        shutil.copyfileobj(part_fd, fd)
+            for part in parts:
+                os.remove(part)
+            os.remove(location + '.parts')
+        digest, size = hashlib.sha256(), 0
+        with open(location, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(StreamedUpload.chunk_size), b''):
+                digest.update(chunk)
+                size += len(chunk)
+        if length and size != length:
+            os.remove(location)
+            raise ValueError('Downloaded %s has %s bytes instead of %s' % (
+                url, size, length))
+        return location, digest.hexdigest()
+
+    @staticmethod
+    def prepare_parts(location, layout):
+        '''Removes part files of given location, unless they were written
+        with the same layout of segments, which is stored for next runs.
+        '''
+        try:
+            with open(location + '.parts') as fd:
+                kept = json.load(fd)
+        except (OSError, ValueError):
+            kept = None
+        if kept != json.loads(json.dumps(layout)):    # bounds as lists
+            for part in glob.glob(glob.escape(location) + '.part[0-9]*'):
+                os.remove(part)
+            with open(location + '.parts', 'w') as fd:
+                json.dump(layout, fd)
+
+    def download_segment(self, url, part, start, end=None):
+        '''Downloads bytes from start to end (inclusive, None for end of file)
+        of given URL to part file, resuming its partial download.
+        '''
+        source = self.source.clone()
+        for attempt in range(source.retries + 1):
+            done = os.path.getsize(part) if os.path.exists(part) else 0
+            if end is not None and start + done > end:
+                return
+            headers = {}
+            if start + done or end is not None:
+                headers['Range'] = 'bytes=%s-%s' % (
+                    start + done, '' if end is None else end)
+            try:
+                r = source.request('GET', url, stream=True, headers=headers)
+                r.raise_for_status()
+                if r.status_code != 206:
+                    if start:
+                        raise ValueError(
+                            'Source ignored range request for %s' % url)
+                    done = 0    # whole file is being sent again
+                with open(part, 'ab' if done else 'wb') as fd:
+                    for chunk in r.iter_content(StreamedUpload.chunk_size):
+                        fd.write(chunk)
+                        METRICS.inc('ckan_sync_downloaded_bytes_total',
+                                    len(chunk))
+                return
+            except (requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError) as e:
+                if attempt == source.retries:
+                    raise
+                logging.warning('Download of %s interrupted (%s); resuming',
+                                url, e)
+
+    def fetch_file(self, url):
+        '''Returns streamed content of source file: either the response,
+        or FileContent of the file in blob cache, if the cached file is
+        still valid according to a conditional request. With SharedSource,
+        it's FileContent of the file downloaded once for all targets
+        wanting it, if there are more of them.
+        '''
+        if isinstance(self.source, SharedSource):
+            content = self.source.shared_file(
+                url, lambda: self.download_shared(url))
+            if content is not None:
+                return content
+        return self.request_file(url)
+
+    def request_file(self, url):
+        if not self.cache:
+            r = self.source.request('GET', url, stream=True)
+            r.raise_for_status()
+            return r
+        r = self.source.request('GET', url, stream=True,
+                                headers=self.cache.conditional_headers(url))
+        if r.status_code == 304:
+            r.close()
+            content = self.cache.open(url)
+            if content is not None:
+                logging.info('Using cached file of %s', url)
+                return content
+            r = self.source.request('GET', url, stream=True)
+        r.raise_for_status()
+        return CachedDownload(self.cache, url, r)
+
+    def download_file(self, url, filename, digest=None):
+        '''Downloads file to temp_path, returns its location.
+        Param digest: optional hashlib object updated with the file content.
+        '''
+        location = '%s/%s' % (self.temp_path, filename)
+        with TRACER.span('download') as span:
+            self.write_content(self.fetch_file(url), location, digest)
+            span['downloaded'] = os.path.getsize(location)
         return location
 
-    def sync_orgs_and_packages(self, orgs, packages):
-        for org in orgs:
-            self.sync_org(org)
-        for package in packages:
-            self.sync_package(package)
+    def download_shared(self, url):
+        '''Downloads file shared by all targets of SharedSource, returns its
+        location (and None for its unknown digest).
+        '''
+        filename = 'shared-%s' % hashlib.sha1(url.encode('utf-8')).hexdigest()
+        location = '%s/%s' % (self.temp_path, filename)
+        with TRACER.span('download') as span:
+            self.write_content(self.request_file(url), location)
+            span['downloaded'] = os.path.getsize(location)
+        return location, None
+
+    @staticmethod
+    def write_content(content, location, digest=None):
+        downloaded = not isinstance(content, FileContent)
+        try:
+            with open(location, 'wb') as fd:
+                for chunk in content.iter_content(StreamedUpload.chunk_size):
+                    fd.write(chunk)
+                    if downloaded:
+                        METRICS.inc('ckan_sync_downloaded_bytes_total',
+                                    len(chunk))
+                    if digest is not None:
+                        digest.update(chunk)
+        finally:
+            content.close()
+
+    def sync_orgs_and_packages(self, orgs, packages, target_snapshot=None,
+                               purges=()):
+        '''Plans sync of given items and executes the plan (unless this is
+        a dry run): organizations and purges first, then packages in pages
+        of self.page_size, so that packages are synced while next ones are
+        fetched. Plans of dry runs are kept in self.last_plan.
+        '''
+        self.last_plan = SyncPlan()
+        plans = (self.plan([], page, target_snapshot)
+                 for page in batches(packages, self.page_size))
+        if orgs or purges:
+            plans = itertools.chain([self.plan(orgs, [], purges=purges)], plans)
+        for plan in plans:
+            if self.dry_run:
+                self.last_plan.groups.extend(plan.groups)
+            else:
+                self.execute(plan)
 
     # Full/partial synchronization of CKAN instances
 
     def sync_full(self):
         logging.info(
             'Started full sync from %s to %s', self.source, self.target)
+        # both instances are compared using bulk snapshots, so that only
+        # write calls are made per package
         source_orgs = self.source.list_organizations()
-        source_packages = self.source.list_packages()
-        self.sync_orgs_and_packages(source_orgs, source_packages)
-        for package in self.target.list_packages():
-            if package not in source_packages:
-                self.target.purge_package(package)
+        source_packages = self.source.snapshot_packages(
+            self.page_size, self.shard)
+        target_packages = self.target.snapshot_packages(
+            self.page_size, self.shard)
+        # only packages of organizations with different digests are planned;
+        # with sync state, is_unchanged compares the digests too, so that
+        # packages changed in target are not skipped by their fingerprints
+        changed = SnapshotDigest(source_packages).differences(
+            SnapshotDigest(target_packages, is_target=True))
+        logging.info('%s of %s source packages differ from target',
+                     len(changed & set(source_packages)), len(source_packages))
+        purges = set(target_packages) - set(source_packages)
+        if purges and not source_packages.complete:
+            # packages missing in the snapshot may still exist in source
+            logging.warning('Not purging %s target packages, snapshot of '
+                            'source is incomplete', len(purges))
+            purges = set()
+        self.sync_orgs_and_packages(
+            source_orgs,
+            [source_packages[name] for name in sorted(changed)
+             if name in source_packages],
+            target_snapshot=target_packages,
+            purges=purges)
         logging.info('Full sync completed')
 
     def sync_packages_only(self):
         logging.info('Syncing packages since %s', self.since_time)
-        changed_packages = self.source.collect_changed_packages(self.since_time)
-        for package in changed_packages:    # only created or updated ones
-            self.sync_package(package)
+        # only created or updated ones, planned as they are fetched
+        changed_packages = self.source.collect_changed_packages(
+            self.since_time, self.page_size)
         to_delete = set(self.target.list_packages()) - set(self.source.list_packages())
-        for package in to_delete:
-            self.target.purge_package(package)
+        self.sync_orgs_and_packages([], changed_packages, purges=to_delete)
         logging.info('Packages sync completed')
 
     def sync(self):
@@ -478,37 +3013,278 @@ class CkanSync:
         if len(revisions) == 0:
             logging.info('No new revisions of source CKAN found; doing nothing.')
             return
-        elif len(revisions) > 200:
-            logging.info('Too many revisions; doing full sync instead.')
-            return self.sync_full()
-        else:
+        self.planner.reset()
+        try:
+            if self.planner.prefers_full(self, revisions):
+                return self.sync_full()
             # collects deleted items too
-            orgs, packages = self.source.collect_changes_from_revisions(revisions)
+            timestamps = []
+            orgs, packages = self.source.collect_changes_from_revisions(
+                revisions, timestamps=timestamps)
+            if self.planner.prefers_full(self, revisions, (orgs, packages)):
+                return self.sync_full()
             self.sync_orgs_and_packages(orgs, packages)
+            self.record_lag(timestamps)
             logging.info('Sync completed')
+        finally:
+            self.save_latencies()
+
+    def record_lag(self, timestamps):
+        '''Records replication lag of applied source revisions.'''
+        now = datetime.datetime.utcnow()
+        lags = [(now - datetime.datetime.fromisoformat(t)).total_seconds()
+                for t in timestamps]
+        for lag in lags:
+            METRICS.observe('ckan_sync_replication_lag_seconds', lag)
+        if lags:
+            METRICS.set('ckan_sync_last_replication_lag_seconds', min(lags))
+
+    def save_latencies(self):
+        '''Stores measured API latencies for planning of next runs
+        (unless this is a dry run, which doesn't change sync state).
+        '''
+        if self.dry_run:
+            return
+        for name, api in (('source', self.source), ('target', self.target)):
+            if self.state and api.latency is not None:
+                self.state.set('latency:%s' % name, str(api.latency))
+
+    @property
+    def revision_key(self):
+        '''Key of the last synced revision in sync state (of this shard).'''
+        if self.shard:
+            return 'last_revision:%s/%s' % self.shard
+        return 'last_revision'
+
+    def save_last_revision(self, revid):
+        if self.state:
+            self.state.set(self.revision_key, revid)
+
+    def enqueue(self, work, orgs, packages):
+        '''Puts given organizations and packages of this shard to WorkQueue.'''
+        if self.coordinator:
+            for org in orgs:
+                work.put('organization', org)
+        for package in packages:
+            if self.in_shard(package):
+                work.put('package', package)
 
-    def sync_loop(self, sleep=60):
-        if not self.since_id:
-            last_revid = self.source.api_action('revision_list')['result'][0]
+    def enqueue_notified(self, work, listener, timeout):
+        '''Puts items notified to given NotificationListener to WorkQueue
+        until timeout (in seconds) expires.
+        '''
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            orgs, packages = listener.wait(deadline - time.monotonic())
+            if orgs or packages:
+                logging.info('Notified of changes of %s organizations and'
+                             ' %s packages', len(orgs), len(packages))
+                self.enqueue(work, orgs, packages)
+
+    def start_workers(self, work):
+        '''Starts threads syncing items of given WorkQueue: the ones planning
+        items and syncing those without file transfers, and the ones doing
+        file transfers (self.workers threads in total, at least one each).
+        '''
+        transfer_workers = max(1, self.workers // 2)
+        for _ in range(max(1, self.workers - transfer_workers)):
+            threading.Thread(
+                target=self._plan_queued, args=(work,), daemon=True).start()
+        for _ in range(transfer_workers):
+            threading.Thread(
+                target=self._transfer_queued, args=(work,), daemon=True).start()
+
+    def _plan_queued(self, work):
+        sync = self._worker_sync()
+        while True:
+            item = work.get()
+            try:
+                kind, name = item
+                if kind == 'organization':
+                    group = sync.plan_org(name)
+                else:
+                    group = sync.plan_package(name)
+                if group is not None and any(
+                        'source' in op for op in group['operations']):
+                    work.put_transfer(item, group)
+                    continue
+                if group is not None:
+                    sync.execute_group(group)
+                work.done(item)
+            except Exception:
+                logging.exception('Failed to sync %s %s', *item)
+                work.done(item, failed=True)
+
+    def _transfer_queued(self, work):
+        sync = self._worker_sync()
+        while True:
+            item, group = work.get_transfer()
+            try:
+                sync.execute_group(group)
+                work.done(item)
+            except Exception:
+                logging.exception('Failed to sync %s', group)
+                work.done(item, failed=True)
+
+    def resume(self):
+        '''Returns change cursor, since which loop mode syncs source: the
+        given one, or the last synced one kept in sync state. If there's
+        none, source is synced by full sync first, since its latest change.
+        '''
+        last_revid = self.since_id
+        if not last_revid and self.state:
+            last_revid = self.state.get(self.revision_key)
+            if last_revid:
+                logging.info('Resuming sync since revision %s', last_revid)
+            for resource_id, package in self.state.unfinished_transfers():
+                logging.warning('Transfer of resource %s of package %s'
+                                ' was not finished', resource_id, package)
+        if not last_revid:
+            last_revid = self.source.feed.latest()
             self.sync_full()
-        else:
-            last_revid = self.since_id
+            self.save_last_revision(last_revid)
+        return last_revid
 
+    def start_loop(self):
+        '''Returns WorkQueue of loop mode, with items left in sync state by
+        previous run, and starts workers syncing its items.
+        '''
+        work = WorkQueue(self.state)
+        if self.state:
+            # shards may share the sync state, each takes its own items
+            queued = collections.defaultdict(list)
+            for kind, name in self.state.queued_items():
+                queued[kind].append(name)
+            self.enqueue(work, queued['organization'], queued['package'])
+        self.start_workers(work)
+        return work
+
+    def poll(self, work, since_id):
+        '''Queues items changed in source since given change cursor to
+        WorkQueue (one iteration of sync loop), returns cursor of the last
+        change. Failed items, whose backoff has expired, are queued again.
+        '''
+        self.record_lag(work.synced_timestamps())
+        timestamps = []
+        new_revs, orgs, packages = self.source.collect_changes(
+            since_id=since_id, timestamps=timestamps)
+        self.enqueue(work, orgs, packages)
+        work.add_timestamps(timestamps)
+        work.retry_failed()
+        if not new_revs:
+            return since_id
+        # queued items are kept in sync state
+        last_revid = self.source.feed.cursor(new_revs[-1])
+        self.save_last_revision(last_revid)
+        return last_revid
+
+    def sync_loop(self, sleep=60, listener=None):
+        '''Periodically polls source revisions for changed items, which are
+        synced by workers of WorkQueue. If NotificationListener is given,
+        notified items are queued as soon as they arrive, and the polling
+        only catches up missed notifications. Failed items are retried by
+        next polls after a backoff.
+        '''
+        last_revid = self.resume()
+        work = self.start_loop()
         while True:
             try:
-                new_revs = self.source.collect_revisions(since_id=last_revid)
-                if len(new_revs) > 0:
-                    orgs, packages = self.source.collect_changes_from_revisions(
-                        new_revs)
-                    self.sync_orgs_and_packages(orgs, packages)
-                    last_revid = new_revs[-1]
+                last_revid = self.poll(work, last_revid)
+                if listener:
+                    self.enqueue_notified(work, listener, sleep)
+                else:
+                    time.sleep(sleep)
+            except:
+                logging.exception('Sync loop failed')
+                sys.exit(1)
+
+
+class MultiTargetSync:
+    """Syncs source CKAN to several targets concurrently, each by its own
+    CkanSync (with its own sync state), so that a slow or failing target
+    doesn't hold up the others. Syncs share reads of the source through
+    SharedSource.
+    """
+    def __init__(self, syncs):
+        self.syncs = syncs      # CkanSync instances by target names
+        self.failures = {}
+
+    def run(self, method_name, **kwargs):
+        '''Calls given method of all syncs, each in its own thread, returns
+        dict of results of successful calls by target names.
+        '''
+        results = {}
+
+        def run(name):
+            try:
+                results[name] = getattr(self.syncs[name], method_name)(**kwargs)
+            except Exception as e:
+                logging.exception('Sync to target %s failed', name)
+                self.failures[name] = e
+
+        threads = [threading.Thread(target=run, args=(name,))
+                   for name in self.syncs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def sync(self):
+        try:
+            self.run('sync')
+        finally:
+            for sync in self.syncs.values():
+                if isinstance(sync.source, SharedSource):
+                    sync.source.remove_files()
+
+    def sync_loop(self, sleep=60, listener=None):
+        '''Polls source for changed items once for all targets, which are
+        queued to WorkQueue of every target (see CkanSync.sync_loop). Every
+        poll starts new generation of SharedSource, so that the targets
+        share reads of the changed items; targets at the same change cursor
+        share the poll of the change feed too.
+        '''
+        # notifications can't be shared by targets (see main)
+        cursors = self.run('resume')
+        if not cursors:
+            sys.exit(1)     # all targets failed
+        works = {name: self.syncs[name].start_loop() for name in cursors}
+        source = self.syncs[next(iter(cursors))].source
+        while True:
+            try:
+                if isinstance(source, SharedSource):
+                    source.next_generation()
+                for name, work in works.items():
+                    cursors[name] = self.syncs[name].poll(work, cursors[name])
                 time.sleep(sleep)
             except:
                 logging.exception('Sync loop failed')
                 sys.exit(1)
 
+    def report_errors(self):
+        '''Logs summary of failed items and targets, returns True if there
+        were any.
+        '''
+        failed = False
+        for name, sync in self.syncs.items():
+            if sync.report_errors():
+                failed = True
+            if name in self.failures:
+                logging.error('Sync to target %s failed: %r',
+                              name, self.failures[name])
+                failed = True
+        return failed
+
 
 def main():
+    def parse_shard(value):
+        match = re.match(r'^(\d+)/(\d+)$', value)
+        if not match or int(match.group(1)) >= int(match.group(2)):
+            raise argparse.ArgumentTypeError(
+                'Wrong shard format, expected i/N with 0 <= i < N')
+        return int(match.group(1)), int(match.group(2))
+
     def interval_to_timestamp(time_interval):
         udict = {
             'm': 'minutes',
@@ -536,37 +3312,133 @@ def main():
              'format: N[mhd] '
              'example: -t5m  = sync items changed within last 5 minutes')
     parser.add_argument('--since-id', '-i',
-        help='start synchronization since this revision id')
+        help='start synchronization since this revision id (or activity'
+             ' timestamp with change_feed = activity)')
+
+    parser.add_argument('--workers', '-w', type=int, default=1,
+        help='number of organizations/packages synced in parallel')
+    parser.add_argument('--shard', type=parse_shard,
+        help='sync only shard i of N (format: i/N) of packages partitioned by'
+             ' hash of their names (including purges of packages missing in'
+             ' source); shard 0 also syncs organizations and empties trash')
+    parser.add_argument('--dry-run', '-n', action='store_true',
+        default=False, help='only print planned write operations as JSON')
+    parser.add_argument('--metrics-file',
+        help='write performance metrics in Prometheus text format'
+             ' to this file after sync')
+    parser.add_argument('--trace', metavar='FILE',
+        help='write spans of sync phases of packages, organizations and'
+             ' resources to this file in Chrome trace format (for'
+             ' chrome://tracing or Perfetto) and print the slowest items')
+    parser.add_argument('--trace-top', type=int, default=10,
+        help='number of the slowest items of each kind printed by --trace')
 
     loop = parser.add_argument_group('loop mode')
     loop.add_argument('--loop', '-l', action='store_true',
         default=False, help='run in loop and periodically check for changes')
     loop.add_argument('--sleep', '-s',
         default=60, help='time interval for periodic checks (in seconds)')
+    loop.add_argument('--listen', metavar='[HOST:]PORT',
+        help='accept notifications of changed items from source CKAN on'
+             ' this port (of localhost by default); polling every --sleep'
+             ' seconds then only catches up missed notifications')
+    loop.add_argument('--metrics-port', type=int,
+        help='serve performance metrics for Prometheus on this port')
 
     args = parser.parse_args()
+    if args.loop and args.dry_run:
+        parser.error('--dry-run can not be used in loop mode')
+    if args.loop and args.trace:
+        parser.error('--trace can not be used in loop mode')
+    TRACER.enabled = bool(args.trace)
 
     config = configparser.ConfigParser()
     config.read(args.config_file)
 
     source = CkanApi(**dict(config.items('source')))
-    target = CkanApi(**dict(config.items('target')))
+    # [target] or several [target:name] sections
+    targets = {section.partition(':')[2] or section:
+               CkanApi(**dict(config.items(section)))
+               for section in config.sections()
+               if section.partition(':')[0] == 'target'}
+    multiple = len(targets) > 1
+    if not targets:
+        parser.error('no [target] section in config file')
+    if multiple and args.listen:
+        parser.error('--listen can be used with one target only')
     since_time = interval_to_timestamp(args.since_time) if args.since_time else None
     temp_path = config['sync']['temp_path']
-    sync = CkanSync(
-        source,
-        target,
-        since_id=args.since_id,
-        since_time=since_time,
-        temp_path=temp_path)
-
-    source.empty_trash()
-    target.empty_trash()
+    page_size = config['sync'].getint('page_size', 1000)
+    stream_uploads = config['sync'].getboolean('stream_uploads', True)
+    large_file_size = config['sync'].getint('large_file_size', 1024 ** 3)
+    download_segments = config['sync'].getint('download_segments', 4)
+    state_path = config['sync'].get('state_path')
+    cache_size = config['sync'].getint('cache_size')
+    cache = BlobCache('%s/cache' % temp_path, cache_size) \
+        if cache_size else None
+    # syncs to several targets read source once
+    shared_source = SharedSource(source, len(targets)) if multiple else None
+
+    syncs = {}
+    for name, target in targets.items():
+        target_state_path = '%s.%s' % (state_path, name) \
+            if multiple and state_path else state_path
+        planner = SyncPlanner(
+            max_revisions=config['sync'].getint('max_incremental_revisions'),
+            max_packages=config['sync'].getint('max_incremental_packages'),
+            incremental_factor=config['sync'].getfloat(
+                'incremental_factor', 1.0),
+            default_latency=config['sync'].getfloat('default_latency', 0.2))
+        target_temp_path = os.path.join(temp_path, name) \
+            if multiple else temp_path
+        os.makedirs(target_temp_path, exist_ok=True)
+        syncs[name] = CkanSync(
+            shared_source.for_target(name) if multiple else source,
+            target,
+            since_id=args.since_id,
+            since_time=since_time,
+            temp_path=target_temp_path,
+            workers=args.workers,
+            page_size=page_size,
+            stream_uploads=stream_uploads,
+            state=SyncState(target_state_path) if target_state_path else None,
+            planner=planner,
+            dry_run=args.dry_run,
+            large_file_size=large_file_size,
+            download_segments=download_segments,
+            shard=args.shard,
+            cache=cache)
+    sync = MultiTargetSync(syncs) if multiple else syncs[next(iter(syncs))]
+
+    if (not args.shard or args.shard[0] == 0) and not args.dry_run:
+        source.empty_trash()
+        for target in targets.values():
+            target.empty_trash()
 
     if args.loop:
-        sync.sync_loop(sleep=int(args.sleep))
+        if args.metrics_port:
+            METRICS.serve(args.metrics_port)
+        listener = None
+        if args.listen:
+            host, _, port = args.listen.rpartition(':')
+            listener = NotificationListener(int(port), host or '127.0.0.1')
+        sync.sync_loop(sleep=int(args.sleep), listener=listener)
     else:
-        sync.sync()
+        try:
+            sync.sync()
+        finally:
+            if args.metrics_file:
+                METRICS.write(args.metrics_file)
+            if args.trace:
+                TRACER.write(args.trace)
+                print(TRACER.summary(args.trace_top), file=sys.stderr)
+        if args.dry_run:
+            plans = {name: (target_sync.last_plan or SyncPlan()).as_dict()
+                     for name, target_sync in syncs.items()}
+            print(json.dumps(plans if multiple else plans.popitem()[1],
+                             indent=2, sort_keys=True))
+        if sync.report_errors():
+            sys.exit(1)
 
 
 if __name__ == '__main__':